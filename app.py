@@ -1,19 +1,43 @@
+import csv
+import functools
+import hashlib
+import io
+import json
+import math
+import mimetypes
 import os
+import sqlite3
 import sys
-from datetime import date
+import time
+from collections import namedtuple
+from datetime import date, datetime
 from email.policy import default
 from enum import unique
 
 import click
-from flask import (Flask, escape, flash, redirect, render_template, request,
-                   url_for)
+import numpy as np
+from flask import (Flask, Response, abort, escape, flash, g,
+                   has_request_context, jsonify, make_response, redirect,
+                   render_template, request, send_from_directory, session,
+                   stream_with_context, url_for)
 from flask_login import (LoginManager, UserMixin, current_user, login_required,
                          login_user, logout_user)
 from flask_sqlalchemy import \
     SQLAlchemy  # 导入扩展类。Flask-SQLAlchemy 版本 2.4.0 Apr 25, 2019 可行
+from jinja2 import FileSystemBytecodeCache
+from markupsafe import Markup
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.pool import QueuePool
 from werkzeug.security import check_password_hash, generate_password_hash
 
+import assets
 import formula
+import surface
+from cache import FragmentCache, TTLCache
+from metrics import Metrics
 
 # 为了部署到线上，我添加了 wsgi.py 文件，这使得我得在 cmd 中先输入 set FLASK_APP=app.py，再输入 flask run 才能运行
 
@@ -40,6 +64,57 @@ app.config['SQLALCHEMY_DATABASE_URI'] = prefix + os.path.join(
 """上面三行就是线上的代码！！！"""
 
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False  # 关闭对模型修改的监控
+
+# SQLite 引擎配置档，和 DATABASE_FILE 一样用环境变量选择：
+#   DATABASE_PROFILE=default     保持 SQLite 默认设置（回滚日志、不开连接池）
+#   DATABASE_PROFILE=production  每个连接都打开 WAL 等 PRAGMA，并使用定长连接池，
+#                                多个 worker 同时读写时不会再一起卡在数据库文件上
+# production 下各项数值也可以单独用环境变量覆盖。
+DATABASE_PROFILE = os.getenv('DATABASE_PROFILE', 'default')
+SQLITE_PRAGMAS = {
+    'production': {
+        'journal_mode': 'WAL',  # 读写互不阻塞
+        'synchronous': os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL'),  # WAL 下 NORMAL 已足够安全
+        'mmap_size': int(os.getenv('SQLITE_MMAP_SIZE', 256 * 1024 * 1024)),  # 字节
+        'cache_size': int(os.getenv('SQLITE_CACHE_SIZE', -64 * 1024)),  # 负数表示 KiB，即 64 MiB
+        'busy_timeout': int(os.getenv('SQLITE_BUSY_TIMEOUT', 5000)),  # 毫秒，代替立即报 database is locked
+        'foreign_keys': 'ON',
+    },
+}
+if DATABASE_PROFILE == 'production':
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'poolclass': QueuePool,  # SQLAlchemy 1.4 对文件型 SQLite 默认不开连接池（NullPool）
+        'pool_size': int(os.getenv('DATABASE_POOL_SIZE', 8)),
+        'max_overflow': int(os.getenv('DATABASE_MAX_OVERFLOW', 8)),
+        'pool_timeout': int(os.getenv('DATABASE_POOL_TIMEOUT', 30)),
+        'connect_args': {
+            'check_same_thread': False,  # 连接由连接池在线程间轮换，同一时刻只被一个线程使用
+            'timeout': int(os.getenv('SQLITE_BUSY_TIMEOUT', 5000)) / 1000,
+        },
+    }
+
+
+@event.listens_for(Engine, 'connect')
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """每个新的 SQLite 连接建立时，按 DATABASE_PROFILE 执行对应的 PRAGMA"""
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    for name, value in SQLITE_PRAGMAS.get(DATABASE_PROFILE, {}).items():
+        cursor.execute('PRAGMA {} = {}'.format(name, value))
+    cursor.close()
+
+
+# 密码哈希的迭代次数（工作量）：越大越难暴力破解，但每次注册、登录也越慢。
+# 哈希里记着它自己的迭代次数，改动后旧密码照样能验证
+app.config['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256:{}'.format(
+    int(os.getenv('PASSWORD_HASH_ITERATIONS', 260000)))
+
+
+def hash_password(password):
+    return generate_password_hash(password, method=app.config['PASSWORD_HASH_METHOD'])
+
+
 # 在扩展类实例化前加载配置
 db = SQLAlchemy(app)
 
@@ -68,7 +143,7 @@ class Admin_info(db.Model, UserMixin):  # 表名将会是 user_info （自动生
     password_hash = db.Column(db.String(128))  # 管理员的密码
 
     def set_password(self, password):  # 用来设置密码的方法，接受密码作为参数
-        self.password_hash = generate_password_hash(password)  # 将生成的密码保持到对应字段
+        self.password_hash = hash_password(password)  # 将生成的密码保持到对应字段
 
     def validate_password(self, password):  # 用于验证密码的方法，接受密码作为参数
         return check_password_hash(self.password_hash, password)  # 返回布尔值
@@ -85,7 +160,15 @@ class Area_info(db.Model):  # 表名将会是 area_info （自动生成，小写
     list_ha_info = db.relationship('Ha_info', backref='ha')
     list_user_info = db.relationship('User_info', backref='user')
     id_admin = db.Column(db.Integer,
-                         db.ForeignKey('admin_info.id_admin'))  # 外键，管理员id
+                         db.ForeignKey('admin_info.id_admin'),
+                         index=True)  # 外键，管理员id
+    # 防治指标公式 Y = E×C×100%／(H×P×F×R) 的参数，每个地区一套，默认值见 formula.CONTROL_DEFAULT
+    e = db.Column(db.Float, nullable=False, default=2, server_default=db.text('2'))  # 生态学系数
+    c = db.Column(db.Float, nullable=False, default=9.50, server_default=db.text('9.50'))  # 防治一次各种费用之和，元/亩
+    h = db.Column(db.Float, nullable=False, default=90, server_default=db.text('90'))  # 大田平均产量，kg/亩
+    p = db.Column(db.Float, nullable=False, default=9.80, server_default=db.text('9.80'))  # 农产品单价，元/kg
+    f = db.Column(db.Float, nullable=False, default=0.7, server_default=db.text('0.7'))  # 害虫为害造成的最大损失率
+    r = db.Column(db.Float, nullable=False, default=0.8, server_default=db.text('0.8'))  # 防治一次的防治效果
 
 
 # 农户 表
@@ -104,10 +187,11 @@ class User_info(db.Model, UserMixin):  # 表名将会是 user_info （自动生
     username = db.Column(db.String(20), unique=True)  # 农户的用户名
     password_hash = db.Column(db.String(128))  # 农户密码
     id_area = db.Column(db.Integer,
-                        db.ForeignKey('area_info.id_area'))  # 外键，农户所属地区id
+                        db.ForeignKey('area_info.id_area'),
+                        index=True)  # 外键，农户所属地区id。area_detail 按地区找农户要用
 
     def set_password(self, password):  # 用来设置密码的方法，接受密码作为参数
-        self.password_hash = generate_password_hash(password)  # 将生成的密码保持到对应字段
+        self.password_hash = hash_password(password)  # 将生成的密码保持到对应字段
 
     def validate_password(self, password):  # 用于验证密码的方法，接受密码作为参数
         return check_password_hash(self.password_hash, password)  # 返回布尔值
@@ -119,17 +203,428 @@ class User_info(db.Model, UserMixin):  # 表名将会是 user_info （自动生
 
 # 棉铃虫信息 表
 class Ha_info(db.Model):  # 表名将会是 ha_info
+    __table_args__ = (
+        db.Index('ix_ha_info_id_area_date', 'id_area', 'date'),
+    )  # 复合索引：按地区取某段时间的记录；它的前缀也覆盖了只按 id_area 的查找，所以 id_area 不再单独建索引
     id_ha = db.Column(db.Integer, primary_key=True)  # 主键
     x1 = db.Column(db.Float)  # 一代幼虫量(头／百株)
     x2 = db.Column(db.Float)  # 二代幼虫量(头／百株)
     y = db.Column(db.Float)  # 理论产量损失率(%)
-    date = db.Column(db.Date, default=date.today())  # 记录时间
+    date = db.Column(db.Date, default=date.today(), index=True)  # 记录时间
     id_user = db.Column(db.Integer,
-                        db.ForeignKey('user_info.id_user'))  # 外键，记录农户id
+                        db.ForeignKey('user_info.id_user'),
+                        index=True)  # 外键，记录农户id
     id_area = db.Column(db.Integer,
                         db.ForeignKey('area_info.id_area'))  # 外键，记录地区id
 
 
+# 棉铃虫信息 按地区、按天的汇总表
+class Ha_summary_info(db.Model):  # 表名将会是 ha_summary_info
+    """每个 (id_area, date) 一行，存 x1、x2、y 的条数、和、平方和、最小值、最大值。
+
+    Ha_info 每次增、改、删都在同一个事务里更新这张表，平均值、方差、极值都能从这里算出，
+    看板和趋势查询只需读 地区数 × 天数 行，而不用扫描全部记录。可以用 flask rebuildsummary 从头重建。
+    """
+    id_area = db.Column(db.Integer,
+                        db.ForeignKey('area_info.id_area'),
+                        primary_key=True)  # 主键之一，地区id
+    date = db.Column(db.Date, primary_key=True)  # 主键之一，记录日期
+    count = db.Column(db.Integer, nullable=False, default=0)  # 记录条数
+    sum_x1 = db.Column(db.Float, nullable=False, default=0)
+    sumsq_x1 = db.Column(db.Float, nullable=False, default=0)
+    min_x1 = db.Column(db.Float)
+    max_x1 = db.Column(db.Float)
+    sum_x2 = db.Column(db.Float, nullable=False, default=0)
+    sumsq_x2 = db.Column(db.Float, nullable=False, default=0)
+    min_x2 = db.Column(db.Float)
+    max_x2 = db.Column(db.Float)
+    sum_y = db.Column(db.Float, nullable=False, default=0)
+    sumsq_y = db.Column(db.Float, nullable=False, default=0)
+    min_y = db.Column(db.Float)
+    max_y = db.Column(db.Float)
+
+
+COLUMNS_SUMMARY = ('x1', 'x2', 'y')  # 汇总的三个量
+
+# 把 ha_info 中满足 {where} 的记录按 (id_area, date) 聚合后累加进汇总表（SQLite 3.24+ 的 UPSERT）
+SQL_SUMMARY_ADD = (
+    'INSERT INTO ha_summary_info (id_area, date, count, ' +
+    ', '.join('sum_{0}, sumsq_{0}, min_{0}, max_{0}'.format(c) for c in COLUMNS_SUMMARY) +
+    ') SELECT id_area, date, COUNT(*), ' +
+    ', '.join('SUM({0}), SUM({0} * {0}), MIN({0}), MAX({0})'.format(c) for c in COLUMNS_SUMMARY) +
+    ' FROM ha_info WHERE ({where}) AND id_area IS NOT NULL AND date IS NOT NULL'
+    ' GROUP BY id_area, date'
+    ' ON CONFLICT (id_area, date) DO UPDATE SET count = count + excluded.count, ' +
+    ', '.join('sum_{0} = sum_{0} + excluded.sum_{0}, sumsq_{0} = sumsq_{0} + excluded.sumsq_{0}, '
+              'min_{0} = MIN(min_{0}, excluded.min_{0}), max_{0} = MAX(max_{0}, excluded.max_{0})'.format(c)
+              for c in COLUMNS_SUMMARY))
+# 从汇总表里减去一条记录的贡献
+SQL_SUMMARY_SUBTRACT = (
+    'UPDATE ha_summary_info SET count = count - 1, ' +
+    ', '.join('sum_{0} = sum_{0} - :{0}, sumsq_{0} = sumsq_{0} - :{0} * :{0}'.format(c)
+              for c in COLUMNS_SUMMARY) +
+    ' WHERE id_area = :id_area AND date = :date')
+# 减去之后极值可能已经失效，只对这一格重新求 MIN / MAX（走 (id_area, date) 复合索引）
+SQL_SUMMARY_REFRESH_EXTREMES = (
+    'UPDATE ha_summary_info SET ' +
+    ', '.join('min_{0} = (SELECT MIN({0}) FROM ha_info WHERE id_area = :id_area AND date = :date), '
+              'max_{0} = (SELECT MAX({0}) FROM ha_info WHERE id_area = :id_area AND date = :date)'.format(c)
+              for c in COLUMNS_SUMMARY) +
+    ' WHERE id_area = :id_area AND date = :date')
+
+
+def summary_add(where, **params):
+    """把满足 where 的 Ha_info 记录累加进汇总表，在当前会话的事务里执行"""
+    db.session.execute(db.text(SQL_SUMMARY_ADD.format(where=where)), params)
+
+
+def summary_remove(row_ha):
+    """从汇总表里减去 row_ha（修改前 / 删除前的值）的贡献。调用方随后要 flush，再调用 summary_refresh()"""
+    if row_ha.id_area is None or row_ha.date is None:
+        return
+    db.session.execute(
+        db.text(SQL_SUMMARY_SUBTRACT), {
+            'id_area': row_ha.id_area,
+            'date': row_ha.date.isoformat(),
+            'x1': float(row_ha.x1 or 0),
+            'x2': float(row_ha.x2 or 0),
+            'y': float(row_ha.y or 0)
+        })
+
+
+def summary_refresh(id_area, date_):
+    """重新求这一格的极值；这一格已经没有记录时删掉它"""
+    if id_area is None or date_ is None:
+        return
+    mark_trend_stale(id_area, date_)
+    params = {'id_area': id_area, 'date': date_.isoformat()}
+    db.session.execute(
+        db.text('DELETE FROM ha_summary_info WHERE id_area = :id_area AND date = :date AND count <= 0'),
+        params)
+    db.session.execute(db.text(SQL_SUMMARY_REFRESH_EXTREMES), params)
+
+
+# 重新拟合回归系数用的累加量，按地区一行
+class Ha_fit_info(db.Model):  # 表名将会是 ha_fit_info
+    """每个地区一行，存 ZᵀZ 的上三角，Z 的每行为 [1, X1, X2, X1^2, X2^2, X1*X2, Y]（X1、X2 为按 50、300 头/百株 换算的水平）。
+
+    和汇总表一样，Ha_info 每次增、改、删都在同一个事务里更新这张表。拟合只需把各地区的行相加再解 6×6 的正规方程，
+    不用扫描全部记录。可以用 flask rebuildfit 从头重建。列 m_i_j 见 COLUMNS_FIT。
+    """
+    id_area = db.Column(db.Integer,
+                        db.ForeignKey('area_info.id_area'),
+                        primary_key=True)  # 主键，地区id
+
+
+FIT_Z = ('1', 'x1 / {:.1f}'.format(formula.LEVEL_X1), 'x2 / {:.1f}'.format(formula.LEVEL_X2),
+         'z1 * z1', 'z2 * z2', 'z1 * z2', 'y')  # Z 的各列，后面的列可引用前面的 z1、z2
+FIT_PAIRS = [(i, j) for i in range(len(FIT_Z)) for j in range(i, len(FIT_Z))]  # ZᵀZ 的上三角
+COLUMNS_FIT = ['m_{}_{}'.format(i, j) for i, j in FIT_PAIRS]  # m_0_0 即记录条数
+for name in COLUMNS_FIT:
+    setattr(Ha_fit_info, name, db.Column(name, db.Float, nullable=False, default=0))
+
+# 把 ha_info 中满足 {where} 的记录按地区聚合后累加进 ha_fit_info
+SQL_FIT_ADD = (
+    'INSERT INTO ha_fit_info (id_area, ' + ', '.join(COLUMNS_FIT) + ') SELECT id_area, ' +
+    ', '.join('SUM(z{} * z{})'.format(i, j) for i, j in FIT_PAIRS) +
+    ' FROM (SELECT id_area, 1.0 AS z0, ' + ', '.join(
+        '{} AS z{}'.format(FIT_Z[i].replace('z1', '(' + FIT_Z[1] + ')').replace('z2', '(' + FIT_Z[2] + ')'), i)
+        for i in range(1, len(FIT_Z))) +
+    ' FROM ha_info WHERE ({where}) AND id_area IS NOT NULL'
+    ' AND x1 IS NOT NULL AND x2 IS NOT NULL AND y IS NOT NULL)'
+    ' GROUP BY id_area'
+    ' ON CONFLICT (id_area) DO UPDATE SET ' +
+    ', '.join('{0} = {0} + excluded.{0}'.format(name) for name in COLUMNS_FIT))
+# 从 ha_fit_info 里减去一条记录的贡献
+SQL_FIT_SUBTRACT = (
+    'UPDATE ha_fit_info SET ' +
+    ', '.join('{0} = {0} - :{0}'.format(name) for name in COLUMNS_FIT) +
+    ' WHERE id_area = :id_area')
+
+
+def fit_add(where, **params):
+    """把满足 where 的 Ha_info 记录累加进 ha_fit_info，在当前会话的事务里执行"""
+    db.session.execute(db.text(SQL_FIT_ADD.format(where=where)), params)
+
+
+def fit_remove(row_ha):
+    """从 ha_fit_info 里减去 row_ha（修改前 / 删除前的值）的贡献"""
+    if row_ha.id_area is None or None in (row_ha.x1, row_ha.x2, row_ha.y):
+        return
+    z = np.append(formula.design_matrix(float(row_ha.x1), float(row_ha.x2), level=True)[0],
+                  float(row_ha.y))
+    params = {name: z[i] * z[j] for name, (i, j) in zip(COLUMNS_FIT, FIT_PAIRS)}
+    params['id_area'] = row_ha.id_area
+    db.session.execute(db.text(SQL_FIT_SUBTRACT), params)
+    db.session.execute(db.text('DELETE FROM ha_fit_info WHERE id_area = :id_area AND m_0_0 <= 0.5'),
+                       params)
+
+
+# 回归系数的版本
+class Coef_info(db.Model):  # 表名将会是 coef_info
+    """flask refit 每拟合一次就新增一行，写入后不再修改。id_coef 即版本号，index() 和 edit() 可以选用任一版本"""
+    id_coef = db.Column(db.Integer, primary_key=True)  # 主键，版本号
+    id_area = db.Column(db.Integer, db.ForeignKey('area_info.id_area'))  # 拟合所用记录的地区，为空表示全部地区
+    area = db.relationship('Area_info')
+    count = db.Column(db.Integer, nullable=False)  # 拟合所用的记录条数
+    r2 = db.Column(db.Float)  # 决定系数 R^2
+    created = db.Column(db.DateTime, default=datetime.now)  # 拟合时间
+    c0 = db.Column(db.Float, nullable=False)  # 常数项
+    c1 = db.Column(db.Float, nullable=False)  # X1
+    c2 = db.Column(db.Float, nullable=False)  # X2
+    c11 = db.Column(db.Float, nullable=False)  # X1^2
+    c22 = db.Column(db.Float, nullable=False)  # X2^2
+    c12 = db.Column(db.Float, nullable=False)  # X1*X2
+
+
+COLUMNS_COEF = ('c0', 'c1', 'c2', 'c11', 'c22', 'c12')  # 与 formula.COEF 同序
+coef_cache = {}  # id_coef -> 系数元组。版本写入后不再修改，缓存不用失效
+
+
+def get_coef(id_coef=None):
+    """取第 id_coef 版的系数，id_coef 为空时取 formula.COEF（已发表的模型）；版本不存在时抛出 ValueError"""
+    if not id_coef:
+        return formula.COEF
+    coef = coef_cache.get(id_coef)
+    if coef is None:
+        row_coef = Coef_info.query.get(id_coef)
+        if row_coef is None:
+            raise ValueError('没有第 {} 版回归系数'.format(id_coef))
+        coef = coef_cache[id_coef] = tuple(getattr(row_coef, name) for name in COLUMNS_COEF)
+    return coef
+
+
+def get_coef_form():
+    """按表单里选的 id_coef 取系数，并记进 session，下次打开页面时默认选中它"""
+    id_coef = request.form.get('id_coef', type=int)
+    coef = get_coef(id_coef)
+    session[SESSION_KEY_COEF] = id_coef
+    return coef
+
+
+def list_coef():
+    """所有系数版本，新的在前，供表单下拉框选择"""
+    return Coef_info.query.options(db.joinedload(Coef_info.area)).order_by(
+        Coef_info.id_coef.desc()).all()
+
+
+def fit_coef(id_area=None):
+    """用 ha_fit_info 里累加好的 ZᵀZ 做最小二乘拟合，id_area 为空时用全部地区。返回新的 Coef_info（未提交），拟合不了时返回 None"""
+    query = db.session.query(*(db.func.sum(getattr(Ha_fit_info, name)) for name in COLUMNS_FIT))
+    if id_area is not None:
+        query = query.filter(Ha_fit_info.id_area == id_area)
+    M = np.zeros((len(FIT_Z), len(FIT_Z)))
+    for (i, j), value in zip(FIT_PAIRS, query.one()):
+        M[i, j] = M[j, i] = value or 0
+    coef, r2 = formula.fit_moments(M)
+    if coef is None:
+        return None
+    row_coef = Coef_info(id_area=id_area, count=int(round(M[0, 0])), r2=r2,
+                         **dict(zip(COLUMNS_COEF, coef)))
+    db.session.add(row_coef)
+    return row_coef
+
+
+# 趋势查询的缓存：键为 (粒度, id_area, date_from, date_to)。记录变动提交后，只失效覆盖到那个地区、那一天的键；
+# 其它 worker 进程里的缓存靠 TREND_CACHE_TTL 过期。
+trend_cache = TTLCache(maxsize=int(os.getenv('TREND_CACHE_SIZE', 512)),
+                       ttl=int(os.getenv('TREND_CACHE_TTL', 60)))
+TREND_BUCKETS = {
+    'day': Ha_summary_info.date,
+    'week': db.func.strftime('%Y-W%W', Ha_summary_info.date),
+    'season': db.func.strftime('%Y', Ha_summary_info.date),  # 新疆棉区一年一季
+}
+
+
+def mark_trend_stale(id_area=None, date_=None):
+    """登记一处变动，事务提交后再失效缓存；id_area 为 None 表示所有地区都可能变了"""
+    db.session.info.setdefault('trend_stale', []).append((id_area, date_))
+
+
+@event.listens_for(db.session, 'after_commit')
+def invalidate_trend_cache(session):
+    for id_area, date_ in session.info.pop('trend_stale', []):
+        if id_area is None or date_ is None:
+            trend_cache.clear()
+            return
+        trend_cache.invalidate(
+            lambda key: key[1] in (None, id_area) and (key[2] is None or key[
+                2] <= date_) and (key[3] is None or date_ <= key[3]))
+
+
+@event.listens_for(db.session, 'after_rollback')
+def forget_trend_stale(session):
+    session.info.pop('trend_stale', None)
+
+
+# 数据版本号：只有一行。各列表页据此生成 ETag，数据没变时直接回 304
+class Data_version_info(db.Model):  # 表名将会是 data_version_info
+    id = db.Column(db.Integer, primary_key=True)  # 固定为 1
+    version = db.Column(db.Integer, nullable=False, default=0)  # 每个改动了数据的事务加 1
+
+
+MODELS_VERSIONED = (Ha_info, Area_info, User_info, Coef_info)  # 这些表一变，列表页就要重新生成
+SQL_DATA_VERSION_BUMP = ('INSERT INTO data_version_info (id, version) VALUES (1, 1)'
+                         ' ON CONFLICT (id) DO UPDATE SET version = version + 1')
+
+
+def bump_data_version(session=None):
+    """在当前事务里把数据版本号加 1，同一事务只加一次。绕过 ORM 的批量写入（executemany、UPDATE）要自己调用"""
+    session = session or db.session
+    if not session.info.get('data_version_bumped'):
+        session.execute(db.text(SQL_DATA_VERSION_BUMP))
+        session.info['data_version_bumped'] = True
+
+
+@event.listens_for(db.session, 'after_flush')
+def bump_data_version_on_flush(session, flush_context):
+    """经 ORM 增、改、删 MODELS_VERSIONED 里的记录时自动加版本号"""
+    if any(isinstance(instance, MODELS_VERSIONED)
+           for instance in (*session.new, *session.dirty, *session.deleted)):
+        bump_data_version(session)
+
+
+@event.listens_for(db.session, 'after_commit')
+@event.listens_for(db.session, 'after_rollback')
+def forget_data_version_bumped(session):
+    session.info.pop('data_version_bumped', None)
+
+
+def get_data_version():
+    return db.session.query(Data_version_info.version).filter_by(id=1).scalar() or 0
+
+
+ETAG_SALT_CODE = str(max(os.path.getmtime(os.path.join(directory, name))
+                         for directory in (app.root_path, os.path.join(app.root_path, app.template_folder))
+                         for name in os.listdir(directory)
+                         if name.endswith(('.py', '.html'))))  # 代码或模板更新后，旧的 ETag 全部作废
+ETAG_SALT = ETAG_SALT_CODE  # load_assets() 再混入静态文件清单，flask buildassets 后页面里的文件名变了
+
+
+def conditional_by_data_version(view):
+    """GET 请求先按 数据版本号 + 用户 + 完整路径（含查询参数） + 本人 session 里的计算结果 生成 ETag，
+    与 If-None-Match 相同就直接回 304，不再执行 view 里的查询和模板渲染。有待显示的 flash 消息时照常渲染。
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if request.method != 'GET' or session.get('_flashes'):
+            return view(*args, **kwargs)
+        etag = hashlib.sha1(json.dumps([
+            ETAG_SALT,
+            get_data_version(),
+            current_user.get_id() if current_user.is_authenticated else None,
+            request.full_path,
+            [session.get(key) for key in (SESSION_KEY_Y0, SESSION_KEY_Y00, SESSION_KEY_COEF)],
+        ]).encode('utf-8')).hexdigest()
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            response = make_response(view(*args, **kwargs))
+        response.set_etag(etag)
+        response.cache_control.private = True
+        response.cache_control.no_cache = True  # 浏览器可以缓存，但每次都要带 If-None-Match 来验证
+        response.vary.add('Cookie')
+        return response
+    return wrapper
+
+
+def query_trend(granularity, id_area=None, date_from=None, date_to=None):
+    """按地区和 日 / 周 / 季 汇总 x1、x2、y 的条数、均值、标准差、极值，返回 list[dict]（带缓存）。
+
+    直接在汇总表 Ha_summary_info 上 GROUP BY，读的是 地区数 × 天数 行，不加载任何 ORM 对象。
+    """
+    key = (granularity, id_area, date_from, date_to)
+    list_trend = trend_cache.get(key)
+    if list_trend is not None:
+        return list_trend
+    bucket = TREND_BUCKETS[granularity].label('bucket')
+    count = db.func.sum(Ha_summary_info.count)
+    columns = [Ha_summary_info.id_area, Area_info.name_area, bucket, count]
+    for c in COLUMNS_SUMMARY:
+        columns += [
+            db.func.sum(getattr(Ha_summary_info, 'sum_' + c)),
+            db.func.sum(getattr(Ha_summary_info, 'sumsq_' + c)),
+            db.func.min(getattr(Ha_summary_info, 'min_' + c)),
+            db.func.max(getattr(Ha_summary_info, 'max_' + c)),
+        ]
+    query = db.session.query(*columns).join(
+        Area_info, Ha_summary_info.id_area == Area_info.id_area)
+    if id_area is not None:
+        query = query.filter(Ha_summary_info.id_area == id_area)
+    if date_from:
+        query = query.filter(Ha_summary_info.date >= date_from)
+    if date_to:
+        query = query.filter(Ha_summary_info.date <= date_to)
+    list_trend = []
+    for row in query.group_by(Ha_summary_info.id_area, Area_info.name_area,
+                              bucket).order_by(Ha_summary_info.id_area,
+                                               bucket):
+        id_area_, name_area, bucket_, n = row[:4]
+        trend = {
+            'id_area': id_area_,
+            'name_area': name_area,
+            'bucket': str(bucket_),
+            'count': n
+        }
+        for i, c in enumerate(COLUMNS_SUMMARY):
+            sum_, sumsq, min_, max_ = row[4 + 4 * i:8 + 4 * i]
+            mean = sum_ / n
+            trend['mean_' + c] = mean
+            trend['std_' + c] = math.sqrt(max(sumsq / n - mean * mean, 0))
+            trend['min_' + c] = min_
+            trend['max_' + c] = max_
+        list_trend.append(trend)
+    trend_cache.set(key, list_trend)
+    return list_trend
+
+
+@app.cli.command()
+def rebuildsummary():
+    """从 Ha_info 全表重建 按地区、按天 的汇总表"""
+    db.create_all()
+    db.session.execute(db.text('DELETE FROM ha_summary_info'))
+    summary_add('1 = 1')
+    bump_data_version()  # 原生 SQL 绕过了 ORM，手动加版本号，否则列表页还会回 304
+    db.session.commit()
+    click.echo('汇总表已重建，共 {} 行。'.format(Ha_summary_info.query.count()))
+
+
+@app.cli.command()
+def rebuildfit():
+    """从 Ha_info 全表重建拟合用的累加量"""
+    db.create_all()
+    db.session.execute(db.text('DELETE FROM ha_fit_info'))
+    fit_add('1 = 1')
+    db.session.commit()
+    click.echo('拟合用的累加量已重建，共 {} 个地区。'.format(Ha_fit_info.query.count()))
+
+
+@app.cli.command()
+@click.option('--name-area', help='只用这个地区的记录拟合，默认用全部地区。')
+@click.option('--per-area', is_flag=True, help='每个地区各拟合一套。')
+def refit(name_area, per_area):
+    """用已有记录重新拟合回归系数，每套系数存为一个新版本"""
+    if per_area:
+        list_area = Area_info.query.join(Ha_fit_info).order_by(Area_info.name_area).all()
+    elif name_area:
+        list_area = Area_info.query.filter_by(name_area=name_area).all()
+        if not list_area:
+            raise click.BadParameter('没有地区 {}'.format(name_area), param_hint='--name-area')
+    else:
+        list_area = [None]  # 全部地区
+    for row_area in list_area:
+        name = '全部地区' if row_area is None else row_area.name_area
+        row_coef = fit_coef(None if row_area is None else row_area.id_area)
+        if row_coef is None:
+            click.echo('{}：记录太少或 X1、X2 共线，无法拟合。'.format(name))
+            continue
+        db.session.flush()
+        click.echo('{}：第 {} 版，{} 条记录，R^2 = {:.4f}，系数 {}'.format(
+            name, row_coef.id_coef, row_coef.count, row_coef.r2,
+            ', '.join('{:.6g}'.format(getattr(row_coef, c)) for c in COLUMNS_COEF)))
+    db.session.commit()
+
+
 @app.cli.command()  # 注册为命令
 @click.option('--drop', is_flag=True, help='Create after drop.')  # 设置选项
 def initdb(drop):
@@ -139,170 +634,646 @@ def initdb(drop):
         db.drop_all()
         print("数据库已清空。")
     db.create_all()
+    if create_area_fts():
+        click.echo('已建立地区名的 FTS5 trigram 索引。')
     click.echo('数据库已初始化。')  # 输出提示信息
 
 
+def add_missing_columns():
+    """给已有的表补上模型里新加的列（create_all 不会改已有的表），返回添加的 (表名, 列名) 列表"""
+    list_added = []
+    ddl_compiler = db.engine.dialect.ddl_compiler(db.engine.dialect, None)
+    for table in db.metadata.sorted_tables:
+        existing = {column['name'] for column in db.inspect(db.engine).get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing:
+                db.session.execute(db.text('ALTER TABLE {} ADD COLUMN {}'.format(
+                    table.name, ddl_compiler.get_column_specification(column))))
+                list_added.append((table.name, column.name))
+    db.session.commit()
+    return list_added
+
+
 @app.cli.command()
-def forge():
-    """Generate fake data."""
-    db.create_all()
-    # 全局变量 list_…… 移动到这个函数内
-    # name_user = '蔡雨豪'
-    # password_hash_user = generate_password_hash('123')
-    # name_admin = 'Yuhao Cai'
-    # password_hash_admin = generate_password_hash('123456')
-
-    list_admin = [{
-        'id_admin': 0,
-        'name_admin': '管理员0',
-        'adminname': 'guanliyua',
-        'password_hash': generate_password_hash('123456')
-    }]  # 创建 admin 实例
+def upgradedb():
+    """在已有的数据库上就地升级：补建缺少的表和索引，不删除任何数据（不需要 --drop）"""
+    db.create_all()  # 只会新建还不存在的表，已有的表不动
+    for table, column in add_missing_columns():
+        click.echo('已给表 {} 添加列 {}。'.format(table, column))
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=db.engine, checkfirst=True)  # 已有的索引会跳过
+            click.echo('索引 {} 已就绪。'.format(index.name))
+    if create_area_fts():
+        click.echo('地区名的 FTS5 trigram 索引已就绪。')
+    if Ha_summary_info.query.first() is None and Ha_info.query.first() is not None:
+        summary_add('1 = 1')  # 汇总表是新建的，先用已有记录填满
+        bump_data_version()
+        db.session.commit()
+        click.echo('汇总表已从已有记录生成。')
+    if Ha_fit_info.query.first() is None and Ha_info.query.first() is not None:
+        fit_add('1 = 1')
+        db.session.commit()
+        click.echo('拟合用的累加量已从已有记录生成。')
+    if db.engine.dialect.name == 'sqlite':
+        with db.engine.begin() as conn:
+            conn.execute(db.text('ANALYZE'))  # 更新统计信息，让查询规划器用上新索引
+    click.echo('数据库已升级。')
 
-    list_area = [{
-        'id_area': 0,
-        'name_area': "伊犁",
-        'id_admin': 0  # 这是外键
-    }]  # 创建 area 实例
 
-    list_user = [{
-        'id_user': 0,
-        'name_user': '农户0',
-        'username': 'nonghu',
-        'password_hash': generate_password_hash('123'),
-        'id_area': 0  # 这是外键
-    }]  # 创建 user 实例
-
-    list_ha = [{
-        'id_ha': 5,
-        'x1': 50,
-        'x2': 300,
-        'y': '25.624243',
-        'date': date(2022, 1, 29),
-        'id_user': 5,
-        'id_area': 5
-    }, {
-        'id_ha': 1,
-        'x1': 10,
-        'x2': 60,
-        'y': 15.435247,
-        'date': date(2022, 1, 25),
-        'id_user': 1,
-        'id_area': 1
-    }, {
-        'id_ha': 2,
-        'x1': 20,
-        'x2': 120,
-        'y': 17.6739028,
-        'date': date(2022, 1, 26),
-        'id_user': 2,
-        'id_area': 2
-    }, {
-        'id_ha': 3,
-        'x1': 30,
-        'x2': 180,
-        'y': 20.1182874,
-        'date': date(2022, 1, 27),
-        'id_user': 3,
-        'id_area': 3
-    }, {
-        'id_ha': 4,
-        'x1': 40,
-        'x2': 250,
-        'y': 22.768400800000002,
-        'date': date(2022, 1, 28),
-        'id_user': 4,
-        'id_area': 4
-    }]
-
-    for row_admin in list_admin:
-        """在此实现下两行 admin 实例所对应的 Admin_info 模型中定义的 list_area_info 接着由 relationship 生成的 InstrumentedList"""
-        print(row_admin)
-        admin = Admin_info(
-            id_admin=row_admin['id_admin'],
-            name_admin=row_admin['name_admin'],
-            adminname=row_admin['adminname'],
-            password_hash=row_admin['password_hash']
-        )  # 把这个 def 中的 name_admin = 'Yuhao Cai' 左传给 Admin_info 模型中的 name_admin
-        print(admin)  # 检查此实例是否创建成功
-        db.session.add(admin)
+NAME_AREA_FORGE = ['伊犁', '喀什', '阿克苏', '昌吉', '博州', '塔城', '巴州', '哈密', '吐鲁番', '和田']  # 虚拟地区名，用完后加编号
 
-    for row_area in list_area:
-        print(row_area)
-        area = Area_info(
-            id_area=row_area['id_area'],
-            name_area=row_area['name_area'],
-            id_admin=row_area['id_admin']  # 这是外键
-        )  # 创建实例
-        print(area)  # 检查此实例是否创建成功
-
-        admin.list_area_info.append(
-            area)  # 向 admin 实例中的 relationship 生成的 list_area_info 传入 area 实例
-        print(
-            admin.list_area_info[-1].name_area)  # 获取 InstrumentedList 的倒数第一个元素
-
-        db.session.add(area)
-
-    for row_user in list_user:
-        print(row_user)
-        user = User_info(
-            id_user=row_user['id_user'],
-            name_user=row_user['name_user'],
-            username=row_user['username'],
-            password_hash=row_user['password_hash'],
-            id_area=row_user['id_area']
-        )  # 把这个 def 中的 name_user = '蔡雨豪' 左传给 User_info 模型中的 name_user
-        print(user)
-
-        area.list_user_info.append(
-            user)  # 向 area 实例中的 relationship 生成的 list_user_info 传入 user 实例
-        print(
-            area.list_user_info[-1].name_user)  # 获取 InstrumentedList 的倒数第一个元素
 
-        db.session.add(user)
+COLUMNS_HA_BULK = ('x1', 'x2', 'y', 'date', 'id_user', 'id_area')  # bulk_insert_ha() 的元组顺序
+
+
+def bulk_insert_ha(rows):
+    """用 executemany 批量插入棉铃虫信息记录，rows 是按 COLUMNS_HA_BULK 顺序排列的元组，date 为 'YYYY-MM-DD' 字符串。
+
+    绕过 ORM，也不逐行组装 dict，直接把元组交给数据库驱动，比 session.add() 快一个数量级。
+    语句在当前会话的连接上执行，由调用方决定何时 commit；汇总表在同一事务里按新插入的 id 区间一次性累加。
+    """
+    id_ha_max = db.session.query(db.func.max(Ha_info.id_ha)).scalar() or 0
+    insert_ha = Ha_info.__table__.insert().compile(
+        dialect=db.engine.dialect, column_keys=list(COLUMNS_HA_BULK))
+    db.session.connection().exec_driver_sql(str(insert_ha), rows)
+    summary_add('id_ha > :id_ha', id_ha=id_ha_max)
+    fit_add('id_ha > :id_ha', id_ha=id_ha_max)
+    mark_trend_stale()
+    bump_data_version()
+
+
+def forge_ha_rows(rng, count, list_id_user, id_area_of_user, year):
+    """用 numpy 一次生成 count 条虚拟棉铃虫信息，y 经 formula 批量计算，返回可交给 bulk_insert_ha() 的元组列表
+
+    一代幼虫量 x1 取 gamma 分布（均值约 20 头/百株，右偏），二代幼虫量 x2 与 x1 正相关（约 6 倍并带对数正态噪声），
+    调查日期落在当年 6~8 月，与田间调查季节一致。
+    """
+    x1 = np.round(rng.gamma(shape=2.0, scale=10.0, size=count), 1)
+    x2 = np.round(x1 * 6 * rng.lognormal(0.0, 0.4, size=count) +
+                  rng.gamma(shape=1.5, scale=20.0, size=count), 1)
+    y = formula.cal_the_complex_of_1_and_2_generation_of_Ha_batch(x1,
+                                                                  x2,
+                                                                  level=True)
+    id_user = rng.choice(list_id_user, size=count)
+    id_area = id_area_of_user[id_user]  # 记录的地区就是记录人所属的地区
+    season_start = date(year, 6, 1).toordinal()
+    list_date = [date.fromordinal(season_start + day).isoformat() for day in range(92)]
+    day = rng.integers(0, 92, size=count)
+    return list(
+        zip(x1.tolist(), x2.tolist(), y.tolist(),
+            [list_date[day_] for day_ in day.tolist()], id_user.tolist(),
+            id_area.tolist()))
 
-    for row_ha in list_ha:
-        print(row_ha)
-        ha = Ha_info(
-            id_ha=row_ha['id_ha'],
-            x1=row_ha['x1'],
-            x2=row_ha['x2'],
-            y=row_ha['y'],
-            date=row_ha['date'],
-            id_user=row_ha['id_user'],
-            id_area=row_ha['id_area']
-        )  # 创建一个 row_ha 记录，等号左边的“x1、x2、y”与ha_info表中的“x1、x2、y”要匹配/相等
-        print(ha)
-
-        area.list_ha_info.append(
-            ha
-        )  # 向 area 实例中的 relationship 生成的 list_ha_info 传入 ha 实例。源自 print(area.list_ha_info)
-        user.list_ha_info.append(
-            ha
-        )  # 向 user 实例中的 relationship 生成的 list_ha_info 传入 ha 实例。源自 print(user.list_ha_info)
-        print(area.list_ha_info[-1].id_user)  # 获取 InstrumentedList 的倒数第一个元素
-        print(user.list_ha_info[-1].id_area)  # 获取 InstrumentedList 的倒数第一个元素
-
-        db.session.add(ha)
 
+@app.cli.command()
+@click.option('--areas', default=5, show_default=True, help='生成的地区数。')
+@click.option('--users', default=10, show_default=True, help='生成的农户数。')
+@click.option('--records', default=100, show_default=True, help='生成的棉铃虫信息记录数。')
+@click.option('--seed', default=0, show_default=True, help='随机数种子，相同种子生成相同数据。')
+@click.option('--chunk-size', default=50000, show_default=True, help='每个事务插入的记录数。')
+def forge(areas, users, records, seed, chunk_size):
+    """Generate fake data.
+
+    生成一致的 管理员-地区-农户-棉铃虫信息 数据：外键都指向本次生成（或已存在）的记录。
+    记录按块批量插入（executemany），每块一个事务，不逐行打印，千万条记录也只需几分钟。
+    所有虚拟农户的密码都是 123，第一个农户的用户名是 nonghu。
+    """
+    db.create_all()
+    rng = np.random.default_rng(seed)
+    time_start = time.perf_counter()
+
+    admin = Admin_info.query.first()
+    if admin is None:
+        admin = Admin_info(name_admin='管理员0',
+                           adminname='guanliyua',
+                           password_hash=hash_password('123456'))
+        db.session.add(admin)
+        db.session.flush()
+    id_admin = admin.id_admin
+
+    # 新数据的 id 接在已有记录后面，地区名、农户名也带上 id，重复执行 forge 不会撞上 UNIQUE 约束
+    id_area_start = (db.session.query(db.func.max(Area_info.id_area)).scalar() or 0) + 1
+    id_user_start = (db.session.query(db.func.max(User_info.id_user)).scalar() or 0) + 1
+    list_area = [{
+        'id_area': id_area_start + i,
+        'name_area': NAME_AREA_FORGE[i] if id_area_start == 1 and i < len(NAME_AREA_FORGE)
+        else '地区{}'.format(id_area_start + i),
+        'id_admin': id_admin
+    } for i in range(areas)]
+    password_hash = hash_password('123')  # 哈希很慢，所有虚拟农户共用一个
+    list_user = [{
+        'id_user': id_user_start + i,
+        'name_user': '农户{}'.format(id_user_start + i),
+        'username': 'nonghu' if id_user_start + i == 1 else 'nonghu{}'.format(id_user_start + i),
+        'password_hash': password_hash,
+        'id_area': list_area[i % areas]['id_area']  # 农户轮流分到各个地区
+    } for i in range(users)] if areas else []
+    if list_area:
+        db.session.execute(Area_info.__table__.insert(), list_area)
+    if list_user:
+        db.session.execute(User_info.__table__.insert(), list_user)
+    bump_data_version()
     db.session.commit()
+    click.echo('已生成 {} 个地区、{} 个农户。'.format(len(list_area), len(list_user)))
+
+    if records and not list_user:
+        click.echo('没有农户，跳过棉铃虫信息记录。')
+        records = 0
+    if records:
+        list_id_user = np.array([row['id_user'] for row in list_user])
+        id_area_of_user = np.zeros(list_id_user.max() + 1, dtype=np.int64)
+        id_area_of_user[list_id_user] = [row['id_area'] for row in list_user]
+        year = date.today().year
+        done = 0
+        while done < records:
+            count = min(chunk_size, records - done)
+            bulk_insert_ha(
+                forge_ha_rows(rng, count, list_id_user, id_area_of_user, year))
+            db.session.commit()  # 一块一个事务
+            done += count
+            click.echo('已写入 {}/{} 条记录。'.format(done, records))
+
     db.session.close()
-    click.echo('虚拟数据已写入数据库 my_ha_data。')
+    seconds = time.perf_counter() - time_start
+    click.echo('虚拟数据已写入数据库 my_ha_data。用时 {:.1f} 秒（{:.0f} 条记录/秒）。'.format(
+        seconds, records / seconds if seconds else 0))
+
+
+IMPORT_CHUNK_SIZE = 10000  # 导入时每块的行数，每块一次批量计算 y、一次 executemany、一次 commit
+IMPORT_REJECTED_SHOWN = 20  # 导入结束时最多列出多少条被拒绝的行
 
 
-# 为了方便数据初始化
-y0 = ''  # 专门为显示 产量损失率(%) 而设计的。发现要在 if 的上一层才能成功渲染。
-y00 = ''  # 为了实现非登录用户的计算功能专门做的
-id_user = ''  # 为实现“用户登录后，自动获取其 id_user、name_user、username、id_area，再把这些用于写入 ha_info 表第 6、7 列的数据”这一功能
-id_area = ''  # 为实现“用户登录后，自动获取其 id_user、name_user、username、id_area，再把这些用于写入 ha_info 表第 6、7 列的数据”这一功能
-NAME_USER = ''  # 为了“用户登录后，自动获取其 name_user”，把 name_user 传给 base.html 的“NAME_USER”，实现“定制化您好”功能
-list_area_name_area = []  # 为了实现对 ha_info 进行模糊查询，转向新的视图函数
-list_area_admin_name_area = []  # 为了实现对 area_info、user_info 进行模糊查询，转向新的视图函数
+def guess_ha_format(filename):
+    """按扩展名判断是 jsonl 还是 csv"""
+    return 'jsonl' if filename.lower().endswith(('.jsonl', '.ndjson', '.json')) else 'csv'
+
+
+def read_ha_lines(stream, fmt):
+    """逐行读取 CSV（首行是表头）或 JSONL 文本流，产出 (行号, dict)；解析不了的行产出 (行号, None)"""
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        for row in reader:
+            yield reader.line_num, row
+        return
+    for lineno, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            row = None
+        yield lineno, row if isinstance(row, dict) else None
+
+
+def parse_count(value):
+    """把 CSV 的字符串或 JSON 的数字严格地转成非负有限浮点数，否则抛出 ValueError"""
+    if isinstance(value, bool) or value is None:
+        raise ValueError(value)
+    try:
+        number = float(value)
+    except OverflowError:  # JSON 里位数极多的整数
+        raise ValueError(value) from None
+    if not math.isfinite(number) or number < 0:
+        raise ValueError(value)
+    return number
+
+
+def import_ha(stream, fmt, chunk_size=IMPORT_CHUNK_SIZE, row_user_default=None):
+    """把 CSV / JSONL 里的田间调查记录分块批量写入 Ha_info。
+
+    每行需要 x1、x2，可选 date（YYYY-MM-DD，默认今天）、name_user（记录人“称呼”）、name_area（地区名）。
+    称呼、地区名通过一次性读入内存的映射换成 id_user、id_area；没有 name_user 时用 row_user_default（上传者），
+    没有 name_area 时用记录人所属的地区。每块的 y 一次向量化算出，再 executemany 并 commit。
+    返回 (写入行数, [(行号, 原因), ...], 用时秒数)。
+    """
+    time_start = time.perf_counter()
+    map_id_area = dict(db.session.query(Area_info.name_area, Area_info.id_area))
+    map_user = {
+        name_user: (id_user, id_area)
+        for name_user, id_user, id_area in db.session.query(
+            User_info.name_user, User_info.id_user, User_info.id_area)
+    }
+    today = date.today().isoformat()
+    list_rejected = []
+    inserted = 0
+    chunk = []  # (x1, x2, date, id_user, id_area)
+
+    def flush():
+        x1, x2, date_, id_user, id_area = zip(*chunk)
+        y = formula.cal_the_complex_of_1_and_2_generation_of_Ha_batch(
+            x1, x2, level=True)
+        bulk_insert_ha(list(zip(x1, x2, y.tolist(), date_, id_user, id_area)))
+        db.session.commit()  # 一块一个事务
+        chunk.clear()
+
+    for lineno, row in read_ha_lines(stream, fmt):
+        if row is None:
+            list_rejected.append((lineno, '无法解析'))
+            continue
+        try:
+            x1 = parse_count(row.get('x1'))
+            x2 = parse_count(row.get('x2'))
+        except (TypeError, ValueError):
+            list_rejected.append((lineno, 'x1、x2 必须是非负数字'))
+            continue
+        name_user = row.get('name_user')
+        row_user = map_user.get(name_user) if name_user else row_user_default
+        if row_user is None:
+            list_rejected.append((lineno, '未知的记录人：{}'.format(name_user)))
+            continue
+        id_user, id_area = row_user
+        name_area = row.get('name_area')
+        if name_area:
+            id_area = map_id_area.get(name_area)
+            if id_area is None:
+                list_rejected.append((lineno, '未知的地区：{}'.format(name_area)))
+                continue
+        try:
+            date_ = date.fromisoformat(row['date']).isoformat() if row.get('date') else today
+        except (TypeError, ValueError):
+            list_rejected.append((lineno, '日期应为 YYYY-MM-DD'))
+            continue
+        chunk.append((x1, x2, date_, id_user, id_area))
+        if len(chunk) >= chunk_size:
+            inserted += len(chunk)
+            flush()
+    if chunk:
+        inserted += len(chunk)
+        flush()
+    return inserted, list_rejected, time.perf_counter() - time_start
+
+
+def summarize_import(inserted, list_rejected, seconds):
+    """导入结果的一行总结"""
+    return '已导入 {} 条记录，拒绝 {} 行，用时 {:.2f} 秒（{:.0f} 行/秒）。'.format(
+        inserted, len(list_rejected), seconds,
+        (inserted + len(list_rejected)) / seconds if seconds else 0)
+
+
+@app.cli.command('import')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']), help='文件格式，默认按扩展名判断。')
+@click.option('--chunk-size', default=IMPORT_CHUNK_SIZE, show_default=True, help='每个事务写入的行数。')
+def import_command(path, fmt, chunk_size):
+    """从 CSV / JSONL 文件批量导入田间调查记录（每行必须有 name_user）"""
+    with open(path, encoding='utf-8-sig', newline='') as stream:
+        inserted, list_rejected, seconds = import_ha(
+            stream, fmt or guess_ha_format(path), chunk_size)
+    for lineno, reason in list_rejected[:IMPORT_REJECTED_SHOWN]:
+        click.echo('第 {} 行被拒绝：{}'.format(lineno, reason))
+    if len(list_rejected) > IMPORT_REJECTED_SHOWN:
+        click.echo('……另有 {} 行被拒绝。'.format(len(list_rejected) - IMPORT_REJECTED_SHOWN))
+    click.echo(summarize_import(inserted, list_rejected, seconds))
+
+
+EXPORT_BATCH_SIZE = 2000  # 导出时每批从游标取的行数，也是每次发送的行数
+COLUMNS_HA_EXPORT = ('id_ha', 'x1', 'x2', 'y', 'date', 'name_user', 'name_area')  # 导出的列，可直接再导入
+
+
+def query_ha_export(name_area=None, name_user=None, date_from=None, date_to=None):
+    """导出用的查询：只取需要的列，连上地区名与记录人“称呼”，过滤条件都放进 SQL"""
+    query = db.session.query(
+        Ha_info.id_ha, Ha_info.x1, Ha_info.x2, Ha_info.y, Ha_info.date,
+        User_info.name_user, Area_info.name_area).outerjoin(
+            User_info, Ha_info.id_user == User_info.id_user).outerjoin(
+                Area_info, Ha_info.id_area == Area_info.id_area)
+    if name_area:
+        query = query.filter(Area_info.name_area == name_area)
+    if name_user:
+        query = query.filter(User_info.name_user == name_user)
+    if date_from:
+        query = query.filter(Ha_info.date >= date_from)
+    if date_to:
+        query = query.filter(Ha_info.date <= date_to)
+    return query.order_by(Ha_info.id_ha).execution_options(
+        stream_results=True).yield_per(EXPORT_BATCH_SIZE)  # 服务端游标，分批取，内存占用与行数无关
+
+
+def iter_export_ha(query, fmt):
+    """把查询结果逐批编码成 CSV / JSONL 文本块，产出 str，第一批在查询开始后立刻产出"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if fmt == 'csv':
+        writer.writerow(COLUMNS_HA_EXPORT)
+    count = 0
+    for row in query:
+        if fmt == 'csv':
+            writer.writerow(row)
+        else:
+            row = dict(zip(COLUMNS_HA_EXPORT, row))
+            row['date'] = row['date'].isoformat() if row['date'] else None
+            buffer.write(json.dumps(row, ensure_ascii=False))
+            buffer.write('\n')
+        count += 1
+        if count % EXPORT_BATCH_SIZE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def parse_date_arg(value):
+    """把 YYYY-MM-DD 形式的参数转成 date，空值返回 None，格式不对抛出 ValueError"""
+    return date.fromisoformat(value) if value else None
+
+
+@app.cli.command('export')
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']), default='csv', show_default=True)
+@click.option('--output', '-o', type=click.File('w', encoding='utf-8'), default='-', help='输出文件，默认标准输出。')
+@click.option('--name-area', help='只导出这个地区的记录。')
+@click.option('--name-user', help='只导出这个记录人的记录。')
+@click.option('--date-from', help='起始日期（含），YYYY-MM-DD。')
+@click.option('--date-to', help='截止日期（含），YYYY-MM-DD。')
+def export_command(fmt, output, name_area, name_user, date_from, date_to):
+    """把棉铃虫信息记录连同地区名、记录人“称呼”流式导出为 CSV / JSONL"""
+    try:
+        query = query_ha_export(name_area, name_user, parse_date_arg(date_from),
+                                parse_date_arg(date_to))
+    except ValueError:
+        raise click.BadParameter('日期应为 YYYY-MM-DD')
+    for text in iter_export_ha(query, fmt):
+        output.write(text)
+
+
+RECOMPUTE_CHUNK_SIZE = 50000  # numpy 方式每块读、算、写回的行数
+RECOMPUTE_TOLERANCE = 1e-9  # |新 y - 旧 y| 不超过它就算没变，不写回
+
+
+def sql_ha_y(coef):
+    """把回归模型写成 SQL 表达式（x1、x2 为 ha_info 里的原始虫口数，按 50、300 头/百株 换算成水平）"""
+    c0, c1, c2, c11, c22, c12 = (repr(float(c)) for c in coef)
+    X1 = '(x1 / {!r})'.format(float(formula.LEVEL_X1))
+    X2 = '(x2 / {!r})'.format(float(formula.LEVEL_X2))
+    return '({c0} + {X1} * ({c1} + {c11} * {X1} + {c12} * {X2}) + {X2} * ({c2} + {c22} * {X2}))'.format(
+        c0=c0, c1=c1, c2=c2, c11=c11, c22=c22, c12=c12, X1=X1, X2=X2)
+
+
+def recompute_where(id_area=None, date_from=None, date_to=None):
+    """重算范围的 WHERE 子句和参数。只用到 id_area、date 两列，ha_info 和 ha_summary_info 都能用"""
+    list_where, params = [], {}
+    if id_area is not None:
+        list_where.append('id_area = :id_area')
+        params['id_area'] = id_area
+    if date_from is not None:
+        list_where.append('date >= :date_from')
+        params['date_from'] = date_from.isoformat()
+    if date_to is not None:
+        list_where.append('date <= :date_to')
+        params['date_to'] = date_to.isoformat()
+    return ' AND '.join(list_where) or '1 = 1', params
+
+
+def recompute_y_sql(coef, where, params, dry_run=False):
+    """方式一：一条 UPDATE 在数据库里算完。先用一条聚合查询得出差异统计，返回统计的 dict"""
+    y_new = sql_ha_y(coef)
+    where = '({}) AND x1 IS NOT NULL AND x2 IS NOT NULL'.format(where)
+    changed = 'y IS NULL OR ABS({} - y) > {!r}'.format(y_new, RECOMPUTE_TOLERANCE)
+    row = db.session.execute(db.text(
+        'SELECT COUNT(*), SUM(CASE WHEN {changed} THEN 1 ELSE 0 END), MAX(ABS({y_new} - y)), '
+        'AVG(y), AVG({y_new}) FROM ha_info WHERE {where}'.format(
+            changed=changed, y_new=y_new, where=where)), params).one()
+    if not dry_run and row[1]:
+        db.session.execute(db.text('UPDATE ha_info SET y = {} WHERE ({}) AND ({})'.format(
+            y_new, where, changed)), params)
+    return {'scanned': row[0], 'changed': row[1] or 0, 'max_diff': row[2] or 0,
+            'mean_old': row[3], 'mean_new': row[4]}
+
+
+def recompute_y_numpy(coef, where, params, dry_run=False, chunk_size=RECOMPUTE_CHUNK_SIZE):
+    """方式二：按 id_ha 分块读出，整块向量化计算，只把变了的行 executemany 写回。返回统计的 dict"""
+    where = '({}) AND x1 IS NOT NULL AND x2 IS NOT NULL'.format(where)
+    total = db.session.execute(db.text('SELECT COUNT(*) FROM ha_info WHERE ' + where), params).scalar()
+    sql_chunk = db.text('SELECT id_ha, x1, x2, y FROM ha_info WHERE {} AND id_ha > :id_ha_last '
+                        'ORDER BY id_ha LIMIT :chunk_size'.format(where))
+    conn = db.session.connection()
+    stats = {'scanned': 0, 'changed': 0, 'max_diff': 0.0, 'mean_old': None, 'mean_new': None}
+    sum_old = sum_new = 0.0
+    count_old = 0
+    id_ha_last = 0
+    with click.progressbar(length=total, label='重算 y') as bar:
+        while True:
+            list_row = conn.execute(sql_chunk, dict(params, id_ha_last=id_ha_last,
+                                                    chunk_size=chunk_size)).fetchall()
+            if not list_row:
+                break
+            id_ha, x1, x2, y_old = (np.array(column, dtype=np.float64) for column in zip(*list_row))
+            y_new = formula.cal_the_complex_of_1_and_2_generation_of_Ha_batch(x1, x2, level=True, coef=coef)
+            diff = np.abs(y_new - y_old)  # y_old 为 NULL 时是 nan
+            mask = ~(diff <= RECOMPUTE_TOLERANCE)
+            stats['scanned'] += len(list_row)
+            stats['changed'] += int(mask.sum())
+            stats['max_diff'] = max(stats['max_diff'], float(np.nanmax(diff, initial=0)))
+            sum_old += float(np.nansum(y_old))
+            count_old += int(np.count_nonzero(~np.isnan(y_old)))
+            sum_new += float(y_new.sum())
+            if not dry_run and mask.any():
+                conn.exec_driver_sql('UPDATE ha_info SET y = ? WHERE id_ha = ?', list(zip(
+                    y_new[mask].tolist(), id_ha[mask].astype(np.int64).tolist())))
+            id_ha_last = int(id_ha[-1])
+            bar.update(len(list_row))
+    if count_old:
+        stats['mean_old'] = sum_old / count_old
+    if stats['scanned']:
+        stats['mean_new'] = sum_new / stats['scanned']
+    return stats
+
+
+def rebuild_derived(where, params):
+    """y 变了以后，重建重算范围内的汇总表格子，以及涉及地区的拟合累加量"""
+    list_id_area = [row[0] for row in db.session.execute(db.text(
+        'SELECT DISTINCT id_area FROM ha_summary_info WHERE ' + where), params)]
+    db.session.execute(db.text('DELETE FROM ha_summary_info WHERE ' + where), params)
+    summary_add(where, **params)
+    if list_id_area:
+        where_area = 'id_area IN ({})'.format(', '.join(str(int(i)) for i in list_id_area))
+        db.session.execute(db.text('DELETE FROM ha_fit_info WHERE ' + where_area))
+        fit_add(where_area)  # 累加量按地区存，整个地区重算
+    mark_trend_stale()
+    bump_data_version()
+
+
+@app.cli.command()
+@click.option('--method', type=click.Choice(['sql', 'numpy']), default='sql', show_default=True,
+              help='sql：一条 UPDATE 在数据库里算；numpy：分块读出向量化计算再 executemany 写回。')
+@click.option('--id-coef', type=int, help='用第几版回归系数（见 flask refit），默认用已发表的模型。')
+@click.option('--name-area', help='只重算这个地区的记录。')
+@click.option('--date-from', help='起始日期（含），YYYY-MM-DD。')
+@click.option('--date-to', help='截止日期（含），YYYY-MM-DD。')
+@click.option('--chunk-size', type=click.IntRange(min=1), default=RECOMPUTE_CHUNK_SIZE, show_default=True,
+              help='numpy 方式每块的行数。')
+@click.option('--dry-run', is_flag=True, help='只统计会改变多少行，不写数据库。')
+def recompute(method, id_coef, name_area, date_from, date_to, chunk_size, dry_run):
+    """回归系数变了以后，按新系数批量重算已有记录的 y，并同步汇总表和拟合累加量"""
+    try:
+        coef = get_coef(id_coef)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint='--id-coef')
+    id_area = None
+    if name_area:
+        id_area = db.session.query(Area_info.id_area).filter_by(name_area=name_area).scalar()
+        if id_area is None:
+            raise click.BadParameter('没有地区 {}'.format(name_area), param_hint='--name-area')
+    try:
+        where, params = recompute_where(id_area, parse_date_arg(date_from), parse_date_arg(date_to))
+    except ValueError:
+        raise click.BadParameter('日期应为 YYYY-MM-DD')
+    time_start = time.perf_counter()
+    if method == 'sql':
+        stats = recompute_y_sql(coef, where, params, dry_run)
+    else:
+        stats = recompute_y_numpy(coef, where, params, dry_run, chunk_size)
+    if dry_run:
+        db.session.rollback()
+    elif stats['changed']:
+        rebuild_derived(where, params)
+        db.session.commit()
+    click.echo('{}：扫描 {} 行，{} {} 行，|Δy| 最大 {:.6g}；y 平均值 {} → {}；用时 {:.1f} 秒。'.format(
+        '试运行' if dry_run else '已完成', stats['scanned'], '将改变' if dry_run else '改变了',
+        stats['changed'], stats['max_diff'],
+        '—' if stats['mean_old'] is None else '{:.4f}'.format(stats['mean_old']),
+        '—' if stats['mean_new'] is None else '{:.4f}'.format(stats['mean_new']),
+        time.perf_counter() - time_start))
+
+
+def query_ha_with_names():
+    """棉铃虫信息记录连同其 地区名、记录人“称呼” 一起查出来（一条 LEFT OUTER JOIN）。
+
+    row_ha.ha 是 Area_info.list_ha_info 的反向关系，row_ha.ha_info 是 User_info.list_ha_info 的反向关系，
+    模板里直接读 row_ha.ha.name_area、row_ha.ha_info.name_user，不会再逐行查询。
+    """
+    return Ha_info.query.options(db.joinedload(Ha_info.ha),
+                                 db.joinedload(Ha_info.ha_info))
+
+
+def escape_like(keyword):
+    """转义 LIKE 里的通配符 % 和 _，配合 escape='\\' 使用"""
+    return keyword.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def has_area_fts():
+    """数据库里是否建好了 area_info_fts（SQLite FTS5 trigram 索引）"""
+    if db.engine.dialect.name != 'sqlite':
+        return False
+    return db.session.execute(
+        db.text("SELECT 1 FROM sqlite_master WHERE name = 'area_info_fts'")
+    ).first() is not None
+
+
+def create_area_fts():
+    """为 Area_info.name_area 建立 FTS5 trigram 索引，并用触发器与 area_info 表保持同步。
+
+    trigram 只能加速 3 个字及以上的子串查询，更短的查询词在 filter_ha_by_name_area() 里回落到普通 LIKE。
+    SQLite 低于 3.34 没有 trigram 分词器，这时什么也不做，返回 False。
+    """
+    if db.engine.dialect.name != 'sqlite':
+        return False
+    try:
+        with db.engine.begin() as conn:
+            conn.execute(
+                db.text("CREATE VIRTUAL TABLE IF NOT EXISTS area_info_fts USING fts5("
+                        "name_area, content='area_info', content_rowid='id_area', "
+                        "tokenize='trigram')"))
+            conn.execute(
+                db.text("CREATE TRIGGER IF NOT EXISTS area_info_fts_ai AFTER INSERT ON area_info BEGIN "
+                        "INSERT INTO area_info_fts(rowid, name_area) VALUES (new.id_area, new.name_area); END"))
+            conn.execute(
+                db.text("CREATE TRIGGER IF NOT EXISTS area_info_fts_ad AFTER DELETE ON area_info BEGIN "
+                        "INSERT INTO area_info_fts(area_info_fts, rowid, name_area) "
+                        "VALUES ('delete', old.id_area, old.name_area); END"))
+            conn.execute(
+                db.text("CREATE TRIGGER IF NOT EXISTS area_info_fts_au AFTER UPDATE ON area_info BEGIN "
+                        "INSERT INTO area_info_fts(area_info_fts, rowid, name_area) "
+                        "VALUES ('delete', old.id_area, old.name_area); "
+                        "INSERT INTO area_info_fts(rowid, name_area) VALUES (new.id_area, new.name_area); END"))
+            conn.execute(
+                db.text("INSERT INTO area_info_fts(area_info_fts) VALUES ('rebuild')"))
+    except OperationalError:  # 没有 FTS5 或 trigram
+        return False
+    return True
+
+
+def filter_ha_by_name_area(query, fuzzy_inquiry_name_area):
+    """按地区名模糊查询过滤棉铃虫信息记录，整个过滤作为一条 id_area IN (子查询) 放进 SQL 里"""
+    if not fuzzy_inquiry_name_area:
+        return query
+    if (len(fuzzy_inquiry_name_area) >= 3
+            and escape_like(fuzzy_inquiry_name_area) == fuzzy_inquiry_name_area
+            and has_area_fts()):
+        list_id_area = db.select(db.literal_column('rowid')).select_from(
+            db.table('area_info_fts')).where(
+                db.literal_column('name_area').like(
+                    '%{}%'.format(fuzzy_inquiry_name_area)))  # 走 trigram 索引
+    else:
+        list_id_area = db.select(Area_info.id_area).where(
+            Area_info.name_area.like(
+                '%{}%'.format(escape_like(fuzzy_inquiry_name_area)),
+                escape='\\'))  # 查询词太短或带通配符时，地区表不大，直接 LIKE
+    return query.filter(Ha_info.id_area.in_(list_id_area))
+
+
+PER_PAGE_HA = 10  # 每页默认显示的棉铃虫信息记录条数
+PER_PAGE_HA_MAX = 200  # per_page 参数的上限，防止一次拉取整张表
+PER_PAGE_AREA = 20  # area_detail 每页默认显示的地区数
+Page_ha = namedtuple('Page_ha', ['items', 'next_before', 'prev_after', 'per_page'])
+
+
+def get_per_page(default_=PER_PAGE_HA):
+    """从查询参数 per_page 读取每页条数，限制在 1 ~ PER_PAGE_HA_MAX"""
+    per_page = request.args.get('per_page', default_, type=int)
+    return min(max(per_page, 1), PER_PAGE_HA_MAX)
+
+
+def count_ha(query=None):
+    """用 SELECT COUNT(*) 统计记录数，不把 ORM 对象读进内存"""
+    if query is None:
+        return db.session.query(db.func.count()).select_from(Ha_info).scalar()
+    return query.order_by(None).with_entities(db.func.count(
+        Ha_info.id_ha)).scalar()  # 主键非空，COUNT(id_ha) 与 COUNT(*) 相同
+
+
+def paginate_keyset(query, key, before=None, after=None, per_page=PER_PAGE_HA):
+    """按主键列 key 倒序做 keyset（游标）分页。
+
+    before：只取 key < before 的记录（下一页，更旧）；after：只取 key > after 的记录（上一页，更新）。
+    两者都没有时就是第一页。每页都只走主键索引扫描 per_page + 1 行，与表有多大无关。
+    返回的 Page_ha 中 next_before / prev_after 为 None 表示没有下一页 / 上一页。
+    """
+    if after is not None:
+        items = query.filter(key > after).order_by(key).limit(
+            per_page + 1).all()  # 先正序取紧挨着 after 的那几条
+        has_newer = len(items) > per_page
+        items = items[:per_page][::-1]  # 再翻转成倒序显示
+        has_older = bool(items) and query.filter(
+            key < getattr(items[-1], key.key)).first() is not None
+    else:
+        if before is not None:
+            query = query.filter(key < before)
+        items = query.order_by(db.desc(key)).limit(per_page + 1).all()
+        has_older = len(items) > per_page
+        items = items[:per_page]
+        has_newer = before is not None and bool(items)
+    return Page_ha(items=items,
+                   next_before=getattr(items[-1], key.key) if has_older else None,
+                   prev_after=getattr(items[0], key.key) if has_newer else None,
+                   per_page=per_page)
+
+
+def paginate_ha(query, before=None, after=None, per_page=PER_PAGE_HA):
+    """按 id_ha 倒序分页读取棉铃虫信息记录，见 paginate_keyset()"""
+    return paginate_keyset(query, Ha_info.id_ha, before, after, per_page)
+
+
+# 每个用户自己的计算结果放在 session 里（签名后存在浏览器 Cookie 中），不再用模块级全局变量，
+# 这样多线程、多进程部署时不同用户之间不会串数据。id_user、id_area、NAME_USER 直接从 current_user 取。
+SESSION_KEY_Y0 = 'y0'  # 专门为显示 产量损失率(%) 而设计的
+SESSION_KEY_Y00 = 'y00'  # 为了实现非登录用户的计算功能专门做的
+SESSION_KEY_COEF = 'id_coef'  # 上次计算选用的回归系数版本
 
 
 @app.route('/', methods=['GET', 'POST'])
+@conditional_by_data_version
 def index():
-    global y0, y00, NAME_USER
     if request.method == 'POST':  # 判断是否是 POST 请求
         if not current_user.is_authenticated:  # 如果当前用户未认证，则 ta 只能使用“计算”功能
             """
@@ -321,13 +1292,18 @@ def index():
             else:
                 try:
                     """防止输入非数字报错"""
-                    y00 = formula.cal_the_complex_of_1_and_2_generation_of_Ha_0(
-                        eval(x1) / 50,
-                        eval(x2) / 300)
-                    return redirect(url_for('index'))  # 重定向回主页
-                except:
-                    flash('请重新输入，不要输入非数字内容！')  # 显示错误提示
+                    x1, x2 = parse_count(x1), parse_count(x2)  # 严格解析，不再 eval 表单内容
+                except ValueError:
+                    flash('请重新输入，X1、X2 须为非负数字！')  # 显示错误提示
                     return redirect(url_for('index'))  # 重定向回主页
+                try:
+                    coef = get_coef_form()
+                except ValueError as e:
+                    flash(str(e))
+                    return redirect(url_for('index'))
+                session[SESSION_KEY_Y00] = formula.cal_the_complex_of_1_and_2_generation_of_Ha_0(
+                    x1, x2, level=True, coef=coef)  # level=True 即按 50、300 头/百株 换算成水平
+                return redirect(url_for('index'))  # 重定向回主页
 
         # 获取表单数据
         x1 = request.form.get('x1')  # 传入表单对应输入字段的 name 值
@@ -338,129 +1314,599 @@ def index():
             return redirect(url_for('index'))  # 重定向回主页
         else:
             try:
-                y0 = formula.cal_the_complex_of_1_and_2_generation_of_Ha_0(
-                    eval(x1) / 50,
-                    eval(x2) / 300)
-            except:
-                flash('请重新输入，不要输入非数字内容！')  # 显示错误提示
+                x1, x2 = parse_count(x1), parse_count(x2)  # 严格解析，不再 eval 表单内容
+            except ValueError:
+                flash('请重新输入，X1、X2 须为非负数字！')  # 显示错误提示
                 return redirect(url_for('index'))  # 重定向回主页
+            try:
+                coef = get_coef_form()
+            except ValueError as e:
+                flash(str(e))
+                return redirect(url_for('index'))
+            y0 = formula.cal_the_complex_of_1_and_2_generation_of_Ha_0(
+                x1, x2, level=True, coef=coef)  # level=True 即按 50、300 头/百株 换算成水平
+        session[SESSION_KEY_Y0] = y0
         # 保存表单数据到数据库
-        global id_user, id_area
         row_ha = Ha_info(
             # id_ha 自增，不必写入
             x1=x1,
             x2=x2,
             y=y0,
             date=date.today(),
-            id_user=id_user,  # 需要从 登录用户 获取。这里 global 来的 id_user 已经被登录界面赋值了！
-            id_area=
-            id_area,  # 需要从 登录用户 获取，参考 test_fk.py。这里 global 来的 id_area 已经被登录界面赋值了！
+            id_user=current_user.id_user,  # 从 登录用户 获取
+            id_area=current_user.id_area,  # 从 登录用户 获取，参考 test_fk.py
         )  # 创建记录。
         # row_ha = Ha_info(x1=x1, x2=x2, date=date.today())  # 创建记录
         db.session.add(row_ha)  # 添加到数据库会话
+        db.session.flush()  # 先拿到自增的 id_ha
+        summary_add('id_ha = :id_ha', id_ha=row_ha.id_ha)  # 同一事务里更新汇总表
+        fit_add('id_ha = :id_ha', id_ha=row_ha.id_ha)  # 以及拟合用的累加量
+        mark_trend_stale(row_ha.id_area, row_ha.date)
         db.session.commit()  # 提交数据库会话
         flash('写入成功！')  # 显示成功创建的提示
         return redirect(url_for('index'))  # 重定向回主页。与下一行代码只能二选一吗？那线上计算的功能就没了。
         # return render_template('index.html', RESULT=str(y0))# 本意是重定向回主页“return redirect(url_for('index'))”
     # user_info = User_info.query.first()  # 读取农户记录。被删掉是因为有了模板上下文处理函数 inject_user()
-    list_ha = Ha_info.query.order_by(db.desc(Ha_info.id_ha)).all(
-    )  # 读取所有棉铃虫信息记录，并倒序排列（db.desc(Ha_info.id_ha)）。方便传给前端。
-    list_ha_limit = Ha_info.query.order_by(db.desc(
-        Ha_info.id_ha)).limit(10).all()  # 读取所有棉铃虫信息记录，但在主页只显示最新的 10 条。
+    page_ha = paginate_ha(
+        query_ha_with_names(),
+        before=request.args.get('before', type=int),
+        after=request.args.get('after', type=int),
+        per_page=get_per_page())  # 按 id_ha 倒序分页读取棉铃虫信息记录，默认每页 10 条。
     """<模型类>.query.<过滤方法（可选）>.<查询方法>"""
+    control = get_control_index()
+    threshold_index = cal_threshold(control)
     return render_template(
         'index.html',
-        Area_info=Area_info,
-        User_info=User_info,
-        list_ha=list_ha,
-        list_ha_limit=list_ha_limit,
-        RESULT=str(y0),
-        RESULT_visitor=str(y00),
-        NAME_USER=NAME_USER
-    )  # 这里不能用 NAME_USER=current_user.name_user 了，因为“登出”后会报错。
-
-
-# 对 ha_info 的全面的友好的展示。对 ha_info 进行模糊查询，转向新的视图函数
+        LIST_COEF=list_coef(),
+        ID_COEF=session.get(SESSION_KEY_COEF),
+        CONTROL=control,
+        THRESHOLD={
+            'y': float(threshold_index['y']),
+            'x1': float(threshold_index['x1']),
+            'x2': float(threshold_index['x2'][0, 0]),  # X1=0 时二代虫的防治指标
+        },
+        count_ha=count_ha(),
+        page_ha=page_ha,
+        list_ha_limit=page_ha.items,
+        RESULT=str(session.get(SESSION_KEY_Y0, '')),
+        RESULT_visitor=str(session.get(SESSION_KEY_Y00, ''))
+    )  # NAME_USER 由模板上下文处理函数 inject_user() 提供，未登录时为空
+
+
+# 对 ha_info 的全面的友好的展示。对 ha_info 进行模糊查询，查询词放在查询参数 fuzzy_inquiry_name_area 里
 @app.route('/ha_detail', methods=['GET', 'POST'])
 @login_required  # 保护
+@conditional_by_data_version
 def ha_detail():
-    global list_area_name_area
-    if request.method == 'POST':  # 判断是否是 POST 请求
-        if not current_user.is_authenticated:  # 如果当前用户未认证
-            return redirect(url_for('index'))  # 重定向回主页
-        # 认证完毕后获取表单数据
+    if request.method == 'POST':  # 兼容旧的 POST 表单：把查询词转成查询参数
         fuzzy_inquiry_name_area = request.form.get(
             'fuzzy_inquiry_name_area')  # 传入表单对应输入字段的 fuzzy_inquiry_name_area 值
-        # 验证数据
-        try:
-            list_area = Area_info.query.order_by(db.desc(
-                Area_info.id_area)).filter(
-                    Area_info.name_area.like(
-                        "%{}%".format(fuzzy_inquiry_name_area))).all(
-                        )  # 返回一个 包含“满足检索要求”的所有记录的 list
-            """用到了python中的正则表达式"""
-            list_area_name_area = []  # 使用前需要“清空”
-            for row_area in list_area:
-                list_area_name_area.append(row_area.name_area)
-            """如果“伊”匹配到了“伊犁”和“伊宁”，这都会被传入"""
-        except:
-            flash('不合规，请重新输入！')  # 显示错误提示
-            return redirect(url_for('ha_detail'))  # 重定向回主页
-        # 从数据库获取……（获取保存表单数据到数据库）
         flash('查询结果如下：')
         return redirect(
-            url_for('ha_detail'))  # 重定向回主页。与下一行代码只能二选一吗？那线上计算的功能就没了。
-    list_ha = Ha_info.query.order_by(db.desc(Ha_info.id_ha)).all(
-    )  # 读取所有棉铃虫信息记录，并倒序排列（db.desc(Ha_info.id_ha)）。之后传给前端。
+            url_for('ha_detail',
+                    fuzzy_inquiry_name_area=fuzzy_inquiry_name_area or None))
+    fuzzy_inquiry_name_area = request.args.get('fuzzy_inquiry_name_area',
+                                               '').strip()
+    query_ha = filter_ha_by_name_area(query_ha_with_names(),
+                                      fuzzy_inquiry_name_area)
+    """如果“伊”匹配到了“伊犁”和“伊宁”，这两个地区的记录都会被查出来；不输入则显示所有记录"""
+    page_ha = paginate_ha(
+        query_ha,
+        before=request.args.get('before', type=int),
+        after=request.args.get('after', type=int),
+        per_page=get_per_page())  # 按 id_ha 倒序分页读取棉铃虫信息记录。之后传给前端。
     """<模型类>.query.<过滤方法（可选）>.<查询方法>"""
     return render_template(
         'ha_detail.html',
-        Area_info=Area_info,
-        User_info=User_info,
-        list_ha=list_ha,
-        list_area_name_area=list_area_name_area,
+        count_ha=count_ha(
+            filter_ha_by_name_area(Ha_info.query, fuzzy_inquiry_name_area)),
+        page_ha=page_ha,
+        list_ha=page_ha.items,
+        fuzzy_inquiry_name_area=fuzzy_inquiry_name_area,
         NAME_USER=current_user.name_user
     )  # 只有登录后才能进入详细查询页，所以此时 NAME_USER=current_user.name_user 可用
 
 
-# 对 area_info 的全面的友好的展示。首页点击“管理员……”即可
+# 上传 CSV / JSONL 批量导入棉铃虫信息记录，没写 name_user 的行记在当前用户名下
+@app.route('/ha_info/import', methods=['POST'])
+@login_required
+def import_upload():
+    file = request.files.get('file')
+    if not file or not file.filename:
+        flash('请选择要导入的 CSV 或 JSONL 文件。')
+        return redirect(url_for('ha_detail'))
+    stream = io.TextIOWrapper(file.stream, encoding='utf-8-sig', newline='')  # 边读边解析，不把整个文件读进内存
+    try:
+        inserted, list_rejected, seconds = import_ha(
+            stream,
+            guess_ha_format(file.filename),
+            row_user_default=(current_user.id_user, current_user.id_area))
+    except UnicodeDecodeError:
+        db.session.rollback()
+        flash('文件必须是 UTF-8 编码。')
+        return redirect(url_for('ha_detail'))
+    for lineno, reason in list_rejected[:IMPORT_REJECTED_SHOWN]:
+        flash('第 {} 行被拒绝：{}'.format(lineno, reason))
+    flash(summarize_import(inserted, list_rejected, seconds))
+    return redirect(url_for('ha_detail'))
+
+
+# 流式导出棉铃虫信息记录，边查边发送
+@app.route('/ha_info/export')
+@login_required
+def export():
+    fmt = request.args.get('format', 'csv')
+    if fmt not in ('csv', 'jsonl'):
+        abort(400)
+    try:
+        query = query_ha_export(
+            name_area=request.args.get('name_area'),
+            name_user=request.args.get('name_user'),
+            date_from=parse_date_arg(request.args.get('date_from')),
+            date_to=parse_date_arg(request.args.get('date_to')))
+    except ValueError:
+        abort(400)
+    return Response(
+        stream_with_context(iter_export_ha(query, fmt)),  # 生成器响应，会话在整个流式发送期间保持可用
+        mimetype='text/csv' if fmt == 'csv' else 'application/x-ndjson',
+        headers={
+            'Content-Disposition':
+            'attachment; filename=ha_info.{}'.format(fmt)
+        })
+
+
+def get_trend_args():
+    """读取趋势查询的参数，不合法时 abort(400)"""
+    granularity = request.args.get('granularity', 'day')
+    if granularity not in TREND_BUCKETS:
+        abort(400)
+    try:
+        date_from = parse_date_arg(request.args.get('date_from'))
+        date_to = parse_date_arg(request.args.get('date_to'))
+    except ValueError:
+        abort(400)
+    return granularity, request.args.get('id_area', type=int), date_from, date_to
+
+
+# 各地区 x1、x2、y 的日 / 周 / 季 趋势
+@app.route('/trend')
+@login_required
+def trend():
+    granularity, id_area, date_from, date_to = get_trend_args()
+    return render_template(
+        'trend.html',
+        list_trend=query_trend(granularity, id_area, date_from, date_to),
+        list_area=db.session.query(Area_info.id_area,
+                                   Area_info.name_area).order_by(
+                                       Area_info.name_area).all(),
+        granularity=granularity,
+        id_area=id_area,
+        date_from=date_from,
+        date_to=date_to,
+        NAME_USER=current_user.name_user)
+
+
+@app.route('/api/trend')
+@login_required
+def api_trend():
+    granularity, id_area, date_from, date_to = get_trend_args()
+    return jsonify(granularity=granularity,
+                   trend=query_trend(granularity, id_area, date_from, date_to))
+
+
+CALCULATE_MAX_BATCH = int(os.getenv('CALCULATE_MAX_BATCH', 100000))  # /api/calculate 一次最多的 (x1, x2) 对数
+CALCULATE_STREAM_CHUNK = 4096  # 流式返回时每块的结果个数
+
+
+def strict_counts(values, name):
+    """JSON 里的虫口数必须是非负有限的数（不接受字符串、布尔值、null），否则抛出 ValueError；返回转好的浮点数列表"""
+    list_number = []
+    for i, value in enumerate(values):
+        try:
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                raise ValueError(value)
+            number = float(value)  # 位数极多的整数转不成浮点数，抛出 OverflowError
+        except (ValueError, OverflowError):
+            number = None
+        if number is None or not math.isfinite(number) or number < 0:
+            raise ValueError('{}[{}] 不是非负数字：{!r}'.format(name, i, value))
+        list_number.append(number)
+    return list_number
+
+
+def read_calculate_json():
+    """接受 {"x1": [...], "x2": [...]} 或 {"pairs": [[x1, x2], ...]}，返回 (x1, x2, level)"""
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        raise ValueError('请求体必须是 JSON 对象')
+    level = data.get('level', True)
+    if not isinstance(level, bool):
+        raise ValueError('level 必须是 true 或 false')
+    if 'pairs' in data:
+        pairs = data['pairs']
+        if not isinstance(pairs, list) or not all(
+                isinstance(pair, list) and len(pair) == 2 for pair in pairs):
+            raise ValueError('pairs 必须是 [[x1, x2], ...]')
+        x1 = [pair[0] for pair in pairs]
+        x2 = [pair[1] for pair in pairs]
+    else:
+        x1, x2 = data.get('x1'), data.get('x2')
+    if not isinstance(x1, list) or not isinstance(x2, list):
+        raise ValueError('x1、x2 必须是数组')
+    if len(x1) != len(x2):
+        raise ValueError('x1 与 x2 长度不同')
+    return x1, x2, level
+
+
+def read_calculate_csv():
+    """接受每行 x1,x2 的 CSV（可带表头），按原始虫口数（level=True）计算，返回 (x1, x2, level)"""
+    x1, x2 = [], []
+    lines = request.get_data(as_text=True).splitlines()
+    for lineno, row in enumerate(csv.reader(lines), 1):
+        if not row:
+            continue
+        if len(row) != 2:
+            raise ValueError('第 {} 行应为 x1,x2'.format(lineno))
+        try:
+            x1_, x2_ = parse_count(row[0]), parse_count(row[1])
+        except ValueError:
+            if lineno == 1 and not x1:  # 表头
+                continue
+            raise ValueError('第 {} 行不是非负数字'.format(lineno))
+        x1.append(x1_)
+        x2.append(x2_)
+    return x1, x2, True
+
+
+def iter_calculate_json(y):
+    """把结果数组分块编码成 {"count": n, "y": [...]}，边算边发"""
+    yield '{{"count": {}, "y": ['.format(len(y))
+    for start in range(0, len(y), CALCULATE_STREAM_CHUNK):
+        yield (',' if start else '') + ','.join(
+            map(repr, y[start:start + CALCULATE_STREAM_CHUNK].tolist()))
+    yield ']}'
+
+
+# 批量计算产量损失率，不写数据库，不需要登录
+@app.route('/api/calculate', methods=['POST'])
+def api_calculate():
+    try:
+        if request.mimetype == 'text/csv':
+            x1, x2, level = read_calculate_csv()
+        else:
+            x1, x2, level = read_calculate_json()
+        if len(x1) > CALCULATE_MAX_BATCH:
+            return jsonify(error='一次最多计算 {} 对'.format(CALCULATE_MAX_BATCH)), 413
+        x1 = strict_counts(x1, 'x1')
+        x2 = strict_counts(x2, 'x2')
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    y = formula.cal_the_complex_of_1_and_2_generation_of_Ha_batch(
+        x1, x2, level=level)  # 整批一次向量化计算
+    return Response(iter_calculate_json(y), mimetype='application/json')
+
+
+SURFACE_CACHE_DIR = os.getenv('SURFACE_CACHE_DIR', os.path.join(
+    app.instance_path, 'loss_surface'))  # 损失曲面的磁盘缓存目录，只存默认网格，每种 level、每种格式一个文件
+SURFACE_MAX_STEPS = 400  # 每个轴最多的网格点数
+SURFACE_DEFAULT = (('x1_min', 0.0), ('x1_max', 100.0), ('x1_steps', 51),
+                   ('x2_min', 0.0), ('x2_max', 600.0), ('x2_steps', 61))  # 默认网格：原始虫口数，头/百株
+SURFACE_MIMETYPES = {'json': 'application/json', 'png': 'image/png', 'svg': 'image/svg+xml'}
+# 其它网格谁都能随便传参数，不能每种都存盘，放在按字节限制大小的内存 LRU 里（每个 worker 进程一份）
+surface_cache = FragmentCache(maxbytes=int(os.getenv('SURFACE_CACHE_BYTES', 32 * 1024 * 1024)))
+
+
+def get_surface_spec():
+    """读取网格参数，不合法时 abort(400)。返回按 SURFACE_DEFAULT 顺序的 dict，另加 level"""
+    spec = {}
+    for name, default_ in SURFACE_DEFAULT:
+        value = request.args.get(name, default_, type=type(default_))
+        if not math.isfinite(value):
+            abort(400)
+        spec[name] = value
+    for axis in ('x1', 'x2'):
+        if not spec[axis + '_min'] < spec[axis + '_max'] \
+                or not 2 <= spec[axis + '_steps'] <= SURFACE_MAX_STEPS:
+            abort(400)
+    spec['level'] = request.args.get('level', '1') not in ('0', 'false')
+    return spec
+
+
+def render_surface(spec, fmt):
+    """计算曲面并编码成 fmt 格式的字节串"""
+    data = surface.cal_loss_surface(**spec)
+    if fmt == 'png':
+        return surface.encode_png(surface.colorize(data['y']), scale=4)
+    if fmt == 'svg':
+        return surface.encode_svg(data).encode('utf-8')
+    return json.dumps(dict(spec, **{key: value.tolist() for key, value in data.items()}),
+                      separators=(',', ':')).encode('utf-8')
+
+
+def read_surface_cached(spec, fmt, etag):
+    """非默认网格：先查内存缓存，没有再算"""
+    body = surface_cache.get(etag, fmt)
+    if body is None:
+        body = render_surface(spec, fmt)
+        surface_cache.set(etag, fmt, body)
+    return body
+
+
+# 产量损失率随 x1、x2 变化的曲面：json 为网格数据，png / svg 为热力图。结果只与网格和回归系数有关，
+# 默认网格算一次后存盘，其它网格只缓存在内存里
+@app.route('/loss_surface.<any(json, png, svg):fmt>')
+def loss_surface(fmt):
+    spec = get_surface_spec()
+    etag = hashlib.sha1(json.dumps([spec, formula.COEF, fmt], sort_keys=True).encode(
+        'utf-8')).hexdigest()
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    elif any(spec[name] != default_ for name, default_ in SURFACE_DEFAULT):
+        response = Response(read_surface_cached(spec, fmt, etag), mimetype=SURFACE_MIMETYPES[fmt])
+    else:
+        path = os.path.join(SURFACE_CACHE_DIR, etag + '.' + fmt)
+        try:
+            with open(path, 'rb') as f:
+                body = f.read()
+        except FileNotFoundError:
+            body = render_surface(spec, fmt)
+            os.makedirs(SURFACE_CACHE_DIR, exist_ok=True)
+            path_tmp = '{}.{}.tmp'.format(path, os.getpid())  # 先写临时文件再改名，并发请求不会读到半个文件
+            with open(path_tmp, 'wb') as f:
+                f.write(body)
+            os.replace(path_tmp, path)
+        response = Response(body, mimetype=SURFACE_MIMETYPES[fmt])
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = 86400
+    return response
+
+
+COLUMNS_CONTROL = tuple(formula.CONTROL_DEFAULT)  # 防治指标公式的参数 e、c、h、p、f、r
+THRESHOLD_X1_GRID = np.arange(0, 101, 10)  # 防治指标表里列出的一代虫数量(头/百株)
+
+
+def parse_control(form, default_=formula.CONTROL_DEFAULT):
+    """从表单或查询参数里读取防治指标公式的参数，没填的用 default_，不是正数时抛出 ValueError"""
+    control = {}
+    for name in COLUMNS_CONTROL:
+        value = form.get(name)
+        try:
+            number = default_[name] if value in (None, '') else parse_count(value)
+        except ValueError:
+            number = 0
+        if not number > 0:
+            raise ValueError('{} 必须是正数'.format(name.upper()))
+        control[name] = number
+    return control
+
+
+def get_control_index():
+    """首页防治指标公式一栏的参数：查询参数里填了的优先，其次是当前用户所在地区保存的，最后是默认值"""
+    control = formula.CONTROL_DEFAULT
+    if current_user.is_authenticated and current_user.user is not None:
+        control = {name: getattr(current_user.user, name) for name in COLUMNS_CONTROL}
+    try:
+        return parse_control(request.args, default_=control)
+    except ValueError as e:
+        flash('请重新输入：{}'.format(e))
+        return control
+
+
+def cal_threshold(control, x1_grid=THRESHOLD_X1_GRID):
+    """按一套或多套参数（各参数为标量或等长数组）算允许损失率与防治指标，返回 ndarray 的 dict
+
+    y：允许产量损失率(%)；x1：没有二代虫时一代虫的防治指标；x2：各 x1_grid 下二代虫的防治指标，形状为 (参数套数, 网格数)。
+    """
+    y = formula.cal_allowed_loss(*(control[name] for name in COLUMNS_CONTROL))
+    return {
+        'y': y,
+        'x1': formula.solve_threshold_x1(y, level=True),
+        'x2': formula.solve_threshold_x2(np.reshape(y, (-1, 1)), x1_grid[np.newaxis, :], level=True),
+    }
+
+
+def query_threshold():
+    """一次查询取出所有地区的参数，一次向量化求出所有地区的防治指标表"""
+    list_row = db.session.query(Area_info.id_area, Area_info.name_area, *(
+        getattr(Area_info, name) for name in COLUMNS_CONTROL)).order_by(Area_info.name_area).all()
+    if not list_row:
+        return []
+    control = {name: np.array([getattr(row, name) for row in list_row]) for name in COLUMNS_CONTROL}
+    threshold = cal_threshold(control)
+    return [
+        dict(row._asdict(),
+             y=float(threshold['y'][i]),
+             x1=float(threshold['x1'][i]),
+             x2=[None if math.isnan(x2) else x2 for x2 in threshold['x2'][i].tolist()])
+        for i, row in enumerate(list_row)
+    ]
+
+
+# 各地区的防治指标表；POST 保存当前用户所在地区的参数
+@app.route('/threshold', methods=['GET', 'POST'])
+@login_required
+def threshold():
+    if request.method == 'POST':
+        row_area = current_user.user
+        if row_area is None:
+            flash('您还没有所属地区，无法保存参数。')
+            return redirect(url_for('threshold'))
+        try:
+            control = parse_control(request.form, default_={
+                name: getattr(row_area, name) for name in COLUMNS_CONTROL})
+        except ValueError as e:
+            flash('请重新输入：{}'.format(e))
+            return redirect(url_for('threshold'))
+        for name, value in control.items():
+            setattr(row_area, name, value)
+        db.session.commit()
+        flash('{} 的防治指标参数已保存。'.format(row_area.name_area))
+        return redirect(url_for('threshold'))
+    return render_template('threshold.html',
+                           list_threshold=query_threshold(),
+                           x1_grid=THRESHOLD_X1_GRID.tolist(),
+                           NAME_USER=current_user.name_user)
+
+
+@app.route('/api/threshold')
+@login_required
+def api_threshold():
+    return jsonify(x1_grid=THRESHOLD_X1_GRID.tolist(), threshold=query_threshold())
+
+
+# 进程内各缓存的命中情况，供监控使用（每个 worker 进程各自统计）
+@app.route('/api/cache')
+@login_required
+def api_cache():
+    stats = {
+        name: {'size': len(cache), 'maxsize': cache.maxsize, 'ttl': cache.ttl,
+               'hits': cache.hits, 'misses': cache.misses}
+        for name, cache in (('user', user_cache), ('trend', trend_cache))
+    }
+    for name, cache in (('row_ha', row_cache), ('surface', surface_cache)):
+        stats[name] = {'size': len(cache), 'bytes': cache.nbytes, 'maxbytes': cache.maxbytes,
+                       'hits': cache.hits, 'misses': cache.misses}
+    return jsonify(stats)
+
+
+# 对 area_info 的全面的友好的展示。首页点击“管理员……”即可。查询词放在查询参数 fuzzy_inquiry_name_area_admin 里
 @app.route('/area_detail', methods=['GET', 'POST'])
 @login_required  # 保护
+@conditional_by_data_version
 def area_detail():
-    global list_area_admin_name_area
-    if request.method == 'POST':  # 判断是否是 POST 请求
-        if not current_user.is_authenticated:  # 如果当前用户未认证
-            return redirect(url_for('index'))  # 重定向回主页
-        # 认证完毕后获取表单数据
+    if request.method == 'POST':  # 兼容旧的 POST 表单：把查询词转成查询参数
         fuzzy_inquiry_name_area_admin = request.form.get(
             'fuzzy_inquiry_name_area_admin'
         )  # 传入表单对应输入字段的 fuzzy_inquiry_name_area_admin 值
-        # 验证数据
-        try:
-            list_area_admin = Area_info.query.order_by(
-                db.desc(Area_info.id_area)).filter(
-                    Area_info.name_area.like(
-                        "%{}%".format(fuzzy_inquiry_name_area_admin))).all(
-                        )  # 返回一个 包含“满足检索要求”的所有记录的 list
-            """用到了python中的正则表达式"""
-            list_area_admin_name_area = []  # 使用前需要“清空”
-            for row_area_admin in list_area_admin:
-                list_area_admin_name_area.append(row_area_admin.name_area)
-            """如果“伊”匹配到了“伊犁”和“伊宁”，这都会被传入"""
-        except:
-            flash('不合规，请重新输入！')  # 显示错误提示
-            return redirect(url_for('ha_detail'))  # 重定向回主页
-        # 从数据库获取……（获取保存表单数据到数据库）
         flash('查询结果如下：')
-        return redirect(url_for('area_detail'))  # 重定向回 area_detail
-    list_area = Area_info.query.order_by(db.desc(
-        Area_info.id_area)).all()  # 读取所有地区信息记录，并倒序排列。之后传给前端，表的最左边会用到。
-    return render_template('area_detail.html',
-                           Area_info=Area_info,
-                           User_info=User_info,
-                           list_area=list_area,
-                           list_area_admin_name_area=list_area_admin_name_area,
-                           NAME_USER=current_user.name_user)
+        return redirect(
+            url_for('area_detail',
+                    fuzzy_inquiry_name_area_admin=fuzzy_inquiry_name_area_admin
+                    or None))  # 重定向回 area_detail
+    fuzzy_inquiry_name_area_admin = request.args.get(
+        'fuzzy_inquiry_name_area_admin', '').strip()
+    query_area = Area_info.query
+    if fuzzy_inquiry_name_area_admin:
+        query_area = query_area.filter(
+            Area_info.name_area.like(
+                '%{}%'.format(escape_like(fuzzy_inquiry_name_area_admin)),
+                escape='\\'))
+        """如果“伊”匹配到了“伊犁”和“伊宁”，这都会被查出来"""
+    page_area = paginate_keyset(
+        query_area,
+        Area_info.id_area,
+        before=request.args.get('before', type=int),
+        after=request.args.get('after', type=int),
+        per_page=get_per_page(PER_PAGE_AREA))  # 按 id_area 倒序分页读取地区
+    list_id_area = [row_area.id_area for row_area in page_area.items]
+    users_of_area = {id_area: [] for id_area in list_id_area}
+    for row_user in User_info.query.filter(User_info.id_area.in_(list_id_area)).order_by(
+            User_info.id_user):  # 这一页所有地区的农户，一条查询
+        users_of_area[row_user.id_area].append(row_user)
+    count_ha_of_area = dict(
+        db.session.query(Ha_summary_info.id_area, db.func.sum(Ha_summary_info.count)).filter(
+            Ha_summary_info.id_area.in_(list_id_area)).group_by(
+                Ha_summary_info.id_area))  # 记录数从汇总表里按地区相加，不扫描 ha_info
+    return render_template(
+        'area_detail.html',
+        count_area=query_area.order_by(None).with_entities(db.func.count(Area_info.id_area)).scalar(),
+        page_area=page_area,
+        list_area=page_area.items,
+        users_of_area=users_of_area,
+        count_ha_of_area=count_ha_of_area,
+        fuzzy_inquiry_name_area_admin=fuzzy_inquiry_name_area_admin,
+        NAME_USER=current_user.name_user)
+
+
+# 表格行的片段缓存：index 与 ha_detail 的每一行渲染一次后按 id_ha 存起来，版本是这一行显示的各个值，
+# 值（包括地区名、农户名）变了版本就对不上，自然重新渲染。edit()、delete() 提交后顺手删掉对应的行。
+# 按估算的内存字节数限制大小，每个 worker 进程各存一份
+row_cache = FragmentCache(maxbytes=int(os.getenv('ROW_CACHE_BYTES', 16 * 1024 * 1024)))
+
+
+@app.template_global()
+def render_row_ha(row_ha):
+    """渲染 templates/row_ha.html 里的一行，命中缓存时直接返回上次渲染的 HTML"""
+    version = (row_ha.x1, row_ha.x2, row_ha.y, row_ha.date,
+               row_ha.ha.name_area if row_ha.ha is not None else None,  # 没有所属地区的农户（flask user 建的）
+               row_ha.ha_info.name_user if row_ha.ha_info is not None else None)
+    html = row_cache.get(row_ha.id_ha, version)
+    if html is None:
+        html = Markup(app.jinja_env.get_template('row_ha.html').render(row_ha=row_ha))
+        row_cache.set(row_ha.id_ha, version, html)
+    return html
+
+
+# Jinja 把编译好的模板字节码存到磁盘，进程重启后不必重新解析、编译模板
+JINJA_CACHE_DIR = os.getenv('JINJA_CACHE_DIR', os.path.join(app.instance_path, 'jinja_cache'))
+os.makedirs(JINJA_CACHE_DIR, exist_ok=True)
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache(JINJA_CACHE_DIR)
+
+
+# 静态文件：flask buildassets 把模板引用的文件按内容哈希改名、预先压缩到 ASSETS_DIR，
+# url_for('static', ...) 随之给出带哈希的文件名，send_static() 按 Accept-Encoding 返回 br / gzip / 原文件，
+# 文件名随内容变，浏览器可以缓存一年不必再问。还没构建时照常返回源文件（bootstrap/ 取自 bootstrap-5.1.3-dist）
+ASSETS_DIR = os.getenv('ASSETS_DIR', os.path.join(app.instance_path, 'assets'))
+ASSETS_MAX_AGE = 365 * 24 * 3600
+assets_manifest = {}  # 文件名 -> {'path': 带哈希的文件名, 'encodings': [...], 'previous': [...]}
+assets_by_path = {}  # 带哈希的文件名（含之前几次构建的） -> 对应的条目
+
+
+def load_assets():
+    global ETAG_SALT
+    assets_manifest.clear()
+    assets_manifest.update(assets.load_manifest(ASSETS_DIR))
+    assets_by_path.clear()
+    for entry in assets_manifest.values():
+        assets_by_path.update((entry_old['path'], entry_old) for entry_old in entry.get('previous', []))
+        assets_by_path[entry['path']] = entry
+    ETAG_SALT = ETAG_SALT_CODE + ':' + hashlib.sha1(json.dumps(
+        assets_manifest, sort_keys=True).encode('utf-8')).hexdigest()[:12]
+
+
+load_assets()
+
+
+@app.url_defaults
+def fingerprint_static(endpoint, values):
+    if endpoint == 'static' and values.get('filename') in assets_manifest:
+        values['filename'] = assets_manifest[values['filename']]['path']
+
+
+def send_static(filename):
+    """带哈希的文件名返回预压缩的版本并允许长期缓存，其它文件名照常返回源文件"""
+    entry = assets_by_path.get(filename)
+    if entry is None:
+        return send_from_directory(*assets.split_source(app.root_path, filename))
+    path, encoding = filename, None
+    for encoding_ in entry['encodings']:
+        if request.accept_encodings[encoding_]:
+            path, encoding = filename + assets.ENCODING_SUFFIX[encoding_], encoding_
+            break
+    response = send_from_directory(ASSETS_DIR, path, mimetype=mimetypes.guess_type(filename)[0]
+                                   or 'application/octet-stream', cache_timeout=ASSETS_MAX_AGE)
+    if encoding is not None:
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Cache-Control'] = 'public, max-age={}, immutable'.format(ASSETS_MAX_AGE)
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+app.view_functions['static'] = send_static
+
+
+@app.cli.command()
+def buildassets():
+    """给模板引用的静态文件加上内容哈希并预先压缩，部署（或改了静态文件）后执行一次，再重启应用"""
+    manifest = assets.build(app.root_path, ASSETS_DIR)
+    load_assets()
+    for filename, entry in manifest.items():
+        click.echo('{} -> {}（{} 字节，预压缩：{}）'.format(
+            filename, entry['path'], entry['size'], '、'.join(entry['encodings']) or '无'))
+    if assets.brotli is None:
+        click.echo('未安装 brotli，只生成了 gzip 版本。')
+    click.echo('已写入 {}'.format(ASSETS_DIR))
 
 
 # 编辑 Ha_info 条目
@@ -477,19 +1923,37 @@ def edit(id_ha):
             flash('Invalid input.')
             return redirect(url_for('edit', id_ha=id_ha))  # 重定向回对应的编辑页面
         else:
+            try:
+                x1, x2 = parse_count(x1), parse_count(x2)  # 严格解析，不再 eval 表单内容
+            except ValueError:
+                flash('请重新输入，X1、X2 须为非负数字！')
+                return redirect(url_for('edit', id_ha=id_ha))
+            try:
+                coef = get_coef_form()
+            except ValueError as e:
+                flash(str(e))
+                return redirect(url_for('edit', id_ha=id_ha))
             y0 = formula.cal_the_complex_of_1_and_2_generation_of_Ha_0(
-                eval(x1) / 50,
-                eval(x2) / 300)
+                x1, x2, level=True, coef=coef)  # level=True 即按 50、300 头/百株 换算成水平
         # 保存更新的表单数据到数据库
+        summary_remove(row_ha)  # 先从汇总表减去旧值
+        fit_remove(row_ha)
         row_ha.x1 = x1  # 更新 x1
         row_ha.x2 = x2  # 更新 x2
         row_ha.y = y0  # 更新 y
+        db.session.flush()
+        summary_add('id_ha = :id_ha', id_ha=row_ha.id_ha)  # 再加上新值
+        fit_add('id_ha = :id_ha', id_ha=row_ha.id_ha)
+        summary_refresh(row_ha.id_area, row_ha.date)
         db.session.commit()  # 提交数据库会话
+        row_cache.pop(id_ha)
         flash('记录已更新。')
         return redirect(url_for('index'))  # 重定向回主页
         """既然我们要编辑某个条目，那么必然要在输入框里提前把对应的数据放进去，以便于进行更新。在模板里，通过表单 <input> 元素的 value 属性即可将它们提前写到输入框里。"""
     return render_template('edit.html',
                            row_ha=row_ha,
+                           LIST_COEF=list_coef(),
+                           ID_COEF=session.get(SESSION_KEY_COEF),
                            NAME_USER=current_user.name_user)  # 传入被编辑的棉铃虫信息记录
 
 
@@ -500,12 +1964,120 @@ def edit(id_ha):
 @login_required  # 登录保护。添加了这个装饰器后，如果未登录的用户访问对应的 URL，Flask-Login 会把用户重定向到登录页面，并显示一个错误提示。
 def delete(id_ha):
     row_ha = Ha_info.query.get_or_404(id_ha)  # 获取电影记录
+    summary_remove(row_ha)  # 同一事务里从汇总表减去这条记录
+    fit_remove(row_ha)
     db.session.delete(row_ha)  # 删除对应的记录
+    db.session.flush()
+    summary_refresh(row_ha.id_area, row_ha.date)
     db.session.commit()  # 提交数据库会话
+    row_cache.pop(id_ha)
     flash('记录已删除。')
     return redirect(url_for('index'))  # 重定向回主页
 
 
+# 按端点统计每个请求的耗时、SQL 条数与 SQL 耗时、模板渲染耗时，由 /metrics 以 Prometheus 文本格式输出。
+# debug 模式下响应头 X-Query-Count 给出本次请求的 SQL 条数
+SLOW_QUERY_SECONDS = float(os.getenv('SLOW_QUERY_SECONDS', 0.1))  # 超过它的 SQL 连同参数写进日志
+metrics = Metrics(prefix='myha_')
+metrics.describe('requests_total', 'counter', '请求数')
+metrics.describe('request_duration_seconds', 'histogram', '请求耗时（秒）')
+metrics.describe('request_sql_queries', 'histogram', '每个请求的 SQL 条数', buckets=(0, 1, 2, 5, 10, 20, 50, 100))
+metrics.describe('sql_queries_total', 'counter', 'SQL 条数')
+metrics.describe('sql_duration_seconds_total', 'counter', 'SQL 耗时（秒）')
+metrics.describe('sql_slow_queries_total', 'counter', '超过 SLOW_QUERY_SECONDS 的 SQL 条数')
+metrics.describe('template_duration_seconds_total', 'counter', '模板渲染耗时（秒），含渲染中懒加载的 SQL')
+metrics.describe('cache_hits_total', 'counter', '进程内缓存命中次数')
+metrics.describe('cache_misses_total', 'counter', '进程内缓存未命中次数')
+metrics.describe('cache_size', 'gauge', '进程内缓存的条数')
+metrics.describe('cache_bytes', 'gauge', '按字节限制大小的进程内缓存估算占用的内存（字节）')
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('time_query_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def record_query(conn, cursor, statement, parameters, context, executemany):
+    seconds = time.perf_counter() - conn.info['time_query_start'].pop()
+    endpoint = 'cli'
+    if has_request_context():
+        endpoint = request.endpoint or 'unknown'
+        g.sql_count = g.get('sql_count', 0) + 1
+        g.sql_seconds = g.get('sql_seconds', 0) + seconds
+    if seconds >= SLOW_QUERY_SECONDS:
+        metrics.inc('sql_slow_queries_total', endpoint=endpoint)
+        app.logger.warning('慢查询（%s）%.3f 秒：%s 参数：%.500r', endpoint, seconds, statement, parameters)
+
+
+@event.listens_for(Engine, 'handle_error')
+def discard_query_timer(exception_context):
+    """出错的 SQL 不会触发 after_cursor_execute，把它的开始时间丢掉"""
+    conn = exception_context.connection
+    if conn is not None and conn.info.get('time_query_start'):
+        conn.info['time_query_start'].pop()
+
+
+class Template_timed(app.jinja_env.template_class):
+    """统计模板渲染耗时的 Jinja 模板类；渲染中嵌套渲染的模板（如 render_row_ha）已含在外层里，不重复计"""
+
+    def render(self, *args, **kwargs):
+        if not has_request_context():
+            return super().render(*args, **kwargs)
+        g.template_depth = g.get('template_depth', 0) + 1
+        time_start = time.perf_counter()
+        try:
+            return super().render(*args, **kwargs)
+        finally:
+            g.template_depth -= 1
+            if not g.template_depth:
+                g.template_seconds = g.get('template_seconds', 0) + time.perf_counter() - time_start
+
+
+app.jinja_env.template_class = Template_timed
+
+
+@app.before_request
+def start_request_timer():
+    g.time_request_start = time.perf_counter()
+
+
+@app.after_request
+def record_request(response):
+    """流式响应（导出、批量计算）在这之后才发送正文，正文里的 SQL 只计入 SQL 的总数与耗时"""
+    endpoint = request.endpoint or 'unknown'  # 404 等没有端点
+    sql_count = g.get('sql_count', 0)
+    metrics.inc('requests_total', endpoint=endpoint, status=response.status_code)
+    metrics.observe('request_duration_seconds',
+                    time.perf_counter() - g.get('time_request_start', time.perf_counter()),
+                    endpoint=endpoint)
+    metrics.observe('request_sql_queries', sql_count, endpoint=endpoint)
+    metrics.inc('sql_queries_total', sql_count, endpoint=endpoint)
+    metrics.inc('sql_duration_seconds_total', g.get('sql_seconds', 0), endpoint=endpoint)
+    metrics.inc('template_duration_seconds_total', g.get('template_seconds', 0), endpoint=endpoint)
+    if app.debug:
+        response.headers['X-Query-Count'] = str(sql_count)
+    return response
+
+
+@app.route('/metrics')
+def prometheus_metrics():
+    for name, cache in (('user', user_cache), ('trend', trend_cache), ('row_ha', row_cache),
+                        ('surface', surface_cache)):
+        metrics.set('cache_hits_total', cache.hits, cache=name)
+        metrics.set('cache_misses_total', cache.misses, cache=name)
+        metrics.set('cache_size', len(cache), cache=name)
+    for name, cache in (('row_ha', row_cache), ('surface', surface_cache)):
+        metrics.set('cache_bytes', cache.nbytes, cache=name)
+    return Response(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+# 400 错误处理函数
+@app.errorhandler(400)
+def bad_request(e):
+    return render_template('400.html'), 400
+
+
 # 404 错误处理函数
 @app.errorhandler(404)  # 传入要处理的错误代码
 def page_not_found(e):  # 接受异常对象作为参数
@@ -516,8 +2088,8 @@ def page_not_found(e):  # 接受异常对象作为参数
 # 模板上下文处理函数
 @app.context_processor
 def inject_user():  # 函数名可以随意修改
-    global NAME_USER
     """现在我们可以删除 404 错误处理函数 errorhandler(404) 和主页视图函数中的 user_info 变量定义，并删除在 render_template() 函数里传入的关键字参数："""
+    NAME_USER = current_user.name_user if current_user.is_authenticated else ''
     return dict(NAME_USER=NAME_USER)  # 需要返回字典，等同于 return {'user': user}
 
 
@@ -590,17 +2162,40 @@ login_manager.login_view = 'login'  # 为了让这个重定向操作正确执行
 """我不会一个 app.py 中实现即可登录“农户”，又可登录“管理员”。"""
 
 
+# 登录用户的缓存：键为 id_user，值为脱离会话的 User_info 副本。settings() 修改用户后立即失效；
+# 其它 worker 进程里的缓存靠 USER_CACHE_TTL 过期。
+user_cache = TTLCache(maxsize=int(os.getenv('USER_CACHE_SIZE', 1024)),
+                      ttl=int(os.getenv('USER_CACHE_TTL', 60)))
+
+
+def snapshot_user(row_user):
+    """复制 row_user 的各列，做成脱离会话（detached）的副本放进缓存。
+
+    缓存里的对象从不直接交给请求使用：每次命中都 merge(load=False) 成当前会话里的新对象，
+    这样各线程互不干扰，current_user.user 之类的关系属性也照常能懒加载。
+    """
+    row_copy = User_info(**{
+        attr.key: getattr(row_user, attr.key) for attr in db.inspect(User_info).column_attrs
+    })
+    make_transient_to_detached(row_copy)
+    return row_copy
+
+
 @login_manager.user_loader
 def load_user(id_user):  # 创建用户加载回调函数，接受用户 ID 作为参数
     """Flask-Login 提供了一个 current_user 变量，注册这个函数的目的是，当程序运行后，如果用户已登录， current_user 变量的值会是当前用户的用户模型类记录。"""
+    row_copy = user_cache.get(int(id_user))
+    if row_copy is not None:
+        return db.session.merge(row_copy, load=False)  # 不查数据库
     user = User_info.query.get(int(id_user))  # 用 ID 作为 User_info 模型的主键查询对应的用户
+    if user is not None:
+        user_cache.set(user.id_user, snapshot_user(user))
     return user  # 返回用户对象
 
 
 # 用户登录
 @app.route('/login', methods=['GET', 'POST'])
 def login():
-    global id_user, id_area, NAME_USER
     if request.method == 'POST':
         username = request.form['username']
         password = request.form['password']
@@ -609,23 +2204,16 @@ def login():
             flash('无效的输入。')
             return redirect(url_for('login'))
 
-        row_user = User_info.query.order_by(db.desc(
-            User_info.id_user)).filter_by(username=username).first(
-            )  # 其实因为 username 是 UNIQUE，这里用.all()也会只返回一条记录。
+        row_user = User_info.query.filter_by(username=username).first(
+        )  # username 是 UNIQUE，只查这一次
         # 验证用户名和密码是否一致
         if row_user:
             """当用户名未写入 User_info，row_user 会查询不到，变成 NoneType，返回 False。这里用 if 来防止报错。 """
             if username == row_user.username and row_user.validate_password(
                     password):
-                id_user = User_info.query.filter_by(username=username).first(
-                ).id_user  # 就在这外键连接，用 filter_by()。这样就可以在 '/' 下把 id_user 的值赋给 row_ha 中的 id_user 了。
-
-                id_area = User_info.query.filter_by(username=username).first(
-                ).id_area  # 就在这外键连接，用 filter_by()。这样就可以在 '/' 下把 id_area 的值赋给 row_ha 中的 id_area 了。
-                NAME_USER = User_info.query.filter_by(
-                    username=username).first().name_user
-
+                # 登录后 id_user、id_area、name_user 都从 current_user 读取，不用再查
                 login_user(row_user)  # 登入用户。注意这里要选用特定的 column
+                user_cache.set(row_user.id_user, snapshot_user(row_user))  # 之后的请求直接从缓存取
                 flash('登录成功')
                 return redirect(url_for('index'))  # 重定向到主页
             else:
@@ -638,6 +2226,13 @@ def login():
         return render_template('login.html')
 
 
+# 新建或取出地区，返回 id_area 以及该地区已有的农户数
+SQL_AREA_UPSERT = (
+    'INSERT INTO area_info (name_area) VALUES (:name_area)'
+    ' ON CONFLICT (name_area) DO UPDATE SET name_area = excluded.name_area'  # DO NOTHING 不会返回已有的行
+    ' RETURNING id_area, (SELECT COUNT(*) FROM user_info WHERE user_info.id_area = area_info.id_area) AS count_user')
+
+
 # 用户注册
 @app.route('/register', methods=['GET', 'POST'])
 def register():
@@ -647,42 +2242,27 @@ def register():
         password_hash = request.form['password']
         name_area = request.form['name_area']  # 这里会想办法用外键连接实现的
 
-        if not name_user or not username or not password_hash:
+        if not name_user or not username or not password_hash or not name_area:
             flash('无效的输入。')
             return redirect(url_for('register'))  # 重定向回注册页面
-        else:
-            # 验证是否被注册
-            if User_info.query.filter_by(
-                    username=username).first() or User_info.query.filter_by(
-                        name_user=name_user).first():
-                flash('“称呼”或用户名已被注册，请更改用户名。')  # 如果验证失败，显示错误消息
-                return redirect(url_for('register'))
-
-            # 信息写入 Area_info
-            else:
-                row_area = Area_info(name_area=name_area)
-            if Area_info.query.filter_by(name_area=name_area).first():
-                flash('这个地区不止您一位注册')  # 如果验证失败，显示错误消息
-                db.session.commit(
-                )  # 先把 name_area 提交数据库的 area_info 表中，这将自动生成 id_area。管理员的 id_admin 先不管了。
-            else:
-                flash('在这个地区，您是第一位注册')
-                db.session.add(row_area)  # 添加到数据库会话
-                db.session.commit(
-                )  # 先把 name_area 提交数据库的 area_info 表中，这将自动生成 id_area。管理员的 id_admin 先不管了。
-
-            # 信息写入 User_info
-            row_user = User_info(
-                name_user=name_user,
-                username=username,
-                password_hash=generate_password_hash(password_hash),
-                id_area=Area_info.query.filter_by(name_area=name_area).first().
-                id_area  # 这里用外键，filter_by()。借助先前把 name_area提交数据库的 area_info 表中自动生成的 id_area。
-            )
-            db.session.add(row_user)  # 添加到数据库会话
+        # 一个事务完成：地区不存在就新建、存在就取它的 id_area（UPSERT ... RETURNING，SQLite 3.35+），再写入农户。
+        # 不先查“是否已被注册”，由 UNIQUE 约束把关，并发注册同一地区也不会冲突
+        row = db.session.execute(db.text(SQL_AREA_UPSERT), {'name_area': name_area}).one()
+        row_user = User_info(name_user=name_user, username=username, id_area=row.id_area)
+        row_user.set_password(password_hash)
+        db.session.add(row_user)  # 添加到数据库会话
+        try:
             db.session.commit()  # 提交数据库会话
-            flash('注册成功。已跳转至登录页，请登录')  # 如果验证失败，显示错误消息
-            return redirect(url_for('login'))
+        except IntegrityError:
+            db.session.rollback()  # 地区的 UPSERT 一起撤销
+            flash('“称呼”或用户名已被注册，请更改用户名。')  # 如果验证失败，显示错误消息
+            return redirect(url_for('register'))
+        if row.count_user:
+            flash('这个地区不止您一位注册')
+        else:
+            flash('在这个地区，您是第一位注册')
+        flash('注册成功。已跳转至登录页，请登录')
+        return redirect(url_for('login'))
     else:
         return render_template('register.html')
 
@@ -691,15 +2271,10 @@ def register():
 @app.route('/logout')
 @login_required  # 用于视图保护，后面会详细介绍
 def logout():
-    global y0, y00, id_user, id_area, NAME_USER, list_area_name_area, list_area_admin_name_area  # VSC 绝了，可以知道这一行 global 来的变量在哪被“修改过！！！”
-    """初始化"""
-    y0 = ''
-    y00 = ''
-    id_user = ''
-    id_area = ''
-    NAME_USER = ''
-    list_area_name_area = []  # 虽然说每次查询前都要清空，但……这里会不会出现“头咬尾巴”的情况啊
-    list_area_admin_name_area = []
+    """初始化：清掉本用户 session 里的计算结果"""
+    session.pop(SESSION_KEY_Y0, None)
+    session.pop(SESSION_KEY_Y00, None)
+    session.pop(SESSION_KEY_COEF, None)
     logout_user()  # 登出用户
     flash('再见~')
     return redirect(url_for('index'))  # 重定向回首页
@@ -729,6 +2304,7 @@ def settings():
         # user = User_info.query.first()
         # user_info.name = name
         db.session.commit()
+        user_cache.pop(current_user.id_user)  # 缓存里的还是旧名字
         flash('您的“称呼”与“用户名”设置成功。')
         return redirect(url_for('index'))
 
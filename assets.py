@@ -0,0 +1,102 @@
+import glob
+import gzip
+import hashlib
+import json
+import os
+import re
+
+try:
+    import brotli  # 可选依赖：装了才生成 .br
+except ImportError:
+    brotli = None
+
+# 模板里引用的静态文件名 -> 源文件所在目录；不在这里的都在 static/ 下
+SOURCE_DIRS = {'bootstrap/': 'bootstrap-5.1.3-dist'}
+COMPRESS_EXTENSIONS = ('.css', '.js', '.svg', '.ico', '.json', '.txt')  # 图片等已压缩的格式不再压缩
+ENCODING_SUFFIX = {'br': '.br', 'gzip': '.gz'}  # 按优先顺序排列
+MANIFEST = 'manifest.json'
+KEEP_PREVIOUS = 5  # 每个文件保留最近几次构建的旧版本，已打开的页面、缓存里的旧 HTML 还能取到
+
+_pattern_static = re.compile(r"""url_for\(\s*['"]static['"]\s*,\s*filename\s*=\s*['"]([^'"]+)['"]\s*\)""")
+
+
+def split_source(root, filename):
+    """静态文件名对应的 (源目录, 目录内的相对路径)，bootstrap/ 开头的取自随仓库附带的 bootstrap-5.1.3-dist"""
+    for prefix, directory in SOURCE_DIRS.items():
+        if filename.startswith(prefix):
+            return os.path.join(root, directory), filename[len(prefix):]
+    return os.path.join(root, 'static'), filename
+
+
+def list_referenced(root):
+    """扫描 templates/ 里所有 url_for('static', filename=...)，返回引用到的文件名（排序、去重）"""
+    set_filename = set()
+    for path in glob.glob(os.path.join(root, 'templates', '*.html')):
+        with open(path, encoding='utf-8') as f:
+            set_filename.update(_pattern_static.findall(f.read()))
+    return sorted(set_filename)
+
+
+def _write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    path_tmp = path + '.tmp'
+    with open(path_tmp, 'wb') as f:
+        f.write(data)
+    os.replace(path_tmp, path)
+
+
+def _remove(out_dir, entry):
+    """删掉一个旧版本的文件及其压缩版本"""
+    for suffix in [''] + [ENCODING_SUFFIX[encoding] for encoding in entry['encodings']]:
+        try:
+            os.remove(os.path.join(out_dir, entry['path'] + suffix))
+        except FileNotFoundError:
+            pass
+
+
+def build(root, out_dir):
+    """把模板引用的静态文件按内容哈希改名复制到 out_dir，并预先压缩成 .gz（装了 brotli 还有 .br），
+    最后写 manifest.json：{文件名: {'path': 带哈希的文件名, 'encodings': [...], 'previous': [旧版本的条目, ...]}}。
+    内容变了时旧版本记进 previous，最多 KEEP_PREVIOUS 个，更早的连同文件一起删掉。同样的输入得到同样的输出。"""
+    manifest_old = load_manifest(out_dir)
+    manifest = {}
+    for filename in list_referenced(root):
+        with open(os.path.join(*split_source(root, filename)), 'rb') as f:
+            data = f.read()
+        stem, ext = os.path.splitext(filename)
+        path = '{}.{}{}'.format(stem, hashlib.sha256(data).hexdigest()[:12], ext)
+        _write(os.path.join(out_dir, path), data)
+        encodings = []
+        if ext in COMPRESS_EXTENSIONS:
+            variants = {'gzip': gzip.compress(data, 9, mtime=0)}  # mtime=0 使输出可复现
+            if brotli is not None:
+                variants['br'] = brotli.compress(data, quality=11)
+            for encoding, suffix in ENCODING_SUFFIX.items():
+                compressed = variants.get(encoding)
+                if compressed is not None and len(compressed) < len(data):  # 压不小就不用
+                    _write(os.path.join(out_dir, path + suffix), compressed)
+                    encodings.append(encoding)
+        entry = {'path': path, 'encodings': encodings, 'size': len(data)}
+        entry_old = manifest_old.get(filename)
+        if entry_old is None:
+            entry['previous'] = []
+        elif entry_old['path'] == path:
+            entry['previous'] = entry_old.get('previous', [])
+        else:
+            entry['previous'] = [entry_ for entry_ in [{key: entry_old[key] for key in ('path', 'encodings')}] +
+                                 entry_old.get('previous', []) if entry_['path'] != path]  # 改回了以前的内容
+            for entry_removed in entry['previous'][KEEP_PREVIOUS:]:
+                _remove(out_dir, entry_removed)
+            del entry['previous'][KEEP_PREVIOUS:]
+        manifest[filename] = entry
+    _write(os.path.join(out_dir, MANIFEST), json.dumps(manifest, indent=2, sort_keys=True).encode('utf-8'))
+    return manifest
+
+
+def load_manifest(out_dir):
+    """读 build() 写的 manifest.json，还没构建过就返回空 dict"""
+    try:
+        with open(os.path.join(out_dir, MANIFEST), encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
@@ -0,0 +1,221 @@
+"""基准测试：在临时 SQLite 数据库上按不同数据量测各视图的延迟分位数与 SQL 条数，以及 formula 各函数的耗时，结果写成 JSON。
+
+用法：python benchmark.py --sizes 1000 --sizes 100000 --sizes 1000000 --output benchmark_results.json
+同一个数据库按 sizes 从小到大逐步补足记录，种子相同则数据相同，两次运行的结果可以直接对比。
+环境变量 DATABASE_PROFILE、PASSWORD_HASH_ITERATIONS 等照常生效，会记进结果的 meta 里。
+"""
+import json
+import os
+import platform
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import click
+import numpy as np
+
+AREAS = 20  # 虚拟地区数
+USERS = 200  # 虚拟农户数，密码都是 123，第一个农户的用户名是 nonghu
+
+
+def percentiles(list_seconds):
+    """把一组耗时（秒）汇总成毫秒的分位数"""
+    ms = np.array(list_seconds) * 1000
+    return {
+        'n': len(ms),
+        'mean_ms': float(ms.mean()),
+        'p50_ms': float(np.percentile(ms, 50)),
+        'p90_ms': float(np.percentile(ms, 90)),
+        'p99_ms': float(np.percentile(ms, 99)),
+        'max_ms': float(ms.max()),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Counter_sql:
+    """数 SQL 条数：挂在引擎的 before_cursor_execute 事件上"""
+
+    def __init__(self, engine):
+        from sqlalchemy import event
+        self.count = 0
+        event.listen(engine, 'before_cursor_execute', self.before_cursor_execute)
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self.count += 1
+
+
+def seed_to(app_module, size, rng):
+    """把 ha_info 补足到 size 条；第一次调用时先用 flask forge 生成地区和农户"""
+    app, db = app_module.app, app_module.db
+    with app.app_context():
+        if app_module.User_info.query.first() is None:
+            result = app.test_cli_runner().invoke(
+                app_module.forge, ['--areas', AREAS, '--users', USERS, '--records', 0])
+            assert result.exit_code == 0, result.output
+        count = app_module.count_ha()
+        list_row = db.session.query(app_module.User_info.id_user, app_module.User_info.id_area).all()
+        list_id_user = np.array([row.id_user for row in list_row])
+        id_area_of_user = np.zeros(list_id_user.max() + 1, dtype=np.int64)
+        id_area_of_user[list_id_user] = [row.id_area for row in list_row]
+        year = datetime.now().year
+        while count < size:
+            chunk = min(50000, size - count)
+            app_module.bulk_insert_ha(app_module.forge_ha_rows(
+                rng, chunk, list_id_user, id_area_of_user, year))
+            db.session.commit()
+            count += chunk
+        db.session.execute(db.text('ANALYZE'))
+        db.session.commit()
+        return count
+
+
+def bench_views(app_module, counter, repeat, rng):
+    """用测试客户端逐个视图请求 repeat 次，返回 {视图: 分位数 + 平均 SQL 条数}"""
+    app, db = app_module.app, app_module.db
+    client = app.test_client()
+    response = client.post('/login', data={'username': 'nonghu', 'password': '123'})
+    assert response.status_code == 302, '登录失败'
+    with app.app_context():
+        list_id_ha = [row[0] for row in db.session.query(app_module.Ha_info.id_ha).order_by(
+            app_module.Ha_info.id_ha.desc()).limit(2 * repeat)]
+    list_id_edit = rng.choice(list_id_ha, size=repeat).tolist()
+    list_id_delete = list_id_ha[:repeat]  # 删最新的几条，不影响下一档数据量
+    name_area = app_module.NAME_AREA_FORGE[0]
+
+    requests = {
+        'index': lambda i: client.get('/'),
+        'index_page_2': lambda i: client.get('/?before={}'.format(list_id_ha[-1])),
+        'ha_detail': lambda i: client.get('/ha_detail'),
+        'ha_detail_search': lambda i: client.get('/ha_detail', query_string={
+            'fuzzy_inquiry_name_area': name_area}),
+        'area_detail': lambda i: client.get('/area_detail'),
+        'login': lambda i: client.post('/login', data={'username': 'nonghu', 'password': '123'}),
+        'edit': lambda i: client.post('/ha_info/edit/{}'.format(list_id_edit[i]), data={
+            'x1': str(round(rng.uniform(0, 100), 1)), 'x2': str(round(rng.uniform(0, 600), 1))}),
+        'delete': lambda i: client.post('/ha_info/delete/{}'.format(list_id_delete[i])),
+    }
+    results = {}
+    for name, request in requests.items():
+        if name not in ('edit', 'delete'):
+            request(0)  # 预热：模板编译、缓存
+        list_seconds, list_count = [], []
+        for i in range(repeat):
+            counter.count = 0
+            time_start = time.perf_counter()
+            response = request(i)
+            list_seconds.append(time.perf_counter() - time_start)
+            list_count.append(counter.count)
+            assert response.status_code in (200, 302), '{} 返回 {}'.format(name, response.status_code)
+        results[name] = dict(percentiles(list_seconds), queries_mean=float(np.mean(list_count)),
+                             queries_max=int(max(list_count)))
+    return results
+
+
+def bench_formula(repeat):
+    """formula 各函数：标量版本每次调用的耗时，批量版本每个元素的耗时"""
+    import formula
+    import surface
+    rng = np.random.default_rng(0)
+    n = 1000000
+    X1 = rng.uniform(0, 100, n)
+    X2 = rng.uniform(0, 600, n)
+    out = np.empty(n)
+    cases = {
+        'cal_the_complex_of_1_and_2_generation_of_Ha_0': (lambda: formula.cal_the_complex_of_1_and_2_generation_of_Ha_0(
+            30, 200, level=True), 1),
+        'cal_1': (lambda: formula.cal_1(30, level=True), 1),
+        'cal_2': (lambda: formula.cal_2(200, level=True), 1),
+        'cal_the_complex_of_1_and_2_generation_of_Ha_batch_1e6': (
+            lambda: formula.cal_the_complex_of_1_and_2_generation_of_Ha_batch(X1, X2, level=True, out=out), n),
+        'cal_1_batch_1e6': (lambda: formula.cal_1_batch(X1, level=True, out=out), n),
+        'cal_2_batch_1e6': (lambda: formula.cal_2_batch(X2, level=True, out=out), n),
+        'solve_threshold_x2_1e6': (lambda: formula.solve_threshold_x2(3.85, X1, level=True), n),
+        'cal_loss_surface_51x61': (lambda: surface.cal_loss_surface(0, 100, 51, 0, 600, 61), 51 * 61),
+    }
+    results = {}
+    for name, (function, elements) in cases.items():
+        loops = 2000 if elements == 1 else 1  # 标量版本太快，一次计时里循环多次
+        list_seconds = []
+        function()
+        for _ in range(repeat):
+            time_start = time.perf_counter()
+            for _ in range(loops):
+                function()
+            list_seconds.append((time.perf_counter() - time_start) / loops)
+        stats = percentiles(list_seconds)
+        stats['elements'] = elements
+        stats['ns_per_element'] = stats['p50_ms'] * 1e6 / elements
+        results[name] = stats
+    return results
+
+
+@click.command()
+@click.option('--sizes', type=int, multiple=True, default=(1000, 100000, 1000000), show_default=True,
+              help='ha_info 的记录数，可重复给出，如 --sizes 1000 --sizes 100000。')
+@click.option('--repeat', default=50, show_default=True, help='每个视图、每个函数的测量次数。')
+@click.option('--seed', default=0, show_default=True, help='随机数种子。')
+@click.option('--output', '-o', default='benchmark_results.json', show_default=True, help='结果文件。')
+@click.option('--db', 'path_db', help='数据库文件，默认在临时目录里新建，结束后删除。')
+def main(sizes, repeat, seed, output, path_db):
+    """按 sizes 逐档补足数据，测各视图与 formula 的耗时"""
+    directory = None
+    if path_db is None:
+        directory = tempfile.TemporaryDirectory()
+        path_db = os.path.join(directory.name, 'benchmark.db')
+    os.environ['DATABASE_FILE'] = os.path.abspath(path_db)  # 必须在 import app 之前设置
+    import app as app_module
+    app_module.app.config['TESTING'] = True
+    with app_module.app.app_context():
+        app_module.db.create_all()
+        counter = Counter_sql(app_module.db.engine)
+
+    rng = np.random.default_rng(seed)
+    results = {
+        'meta': {
+            'time': datetime.now().isoformat(timespec='seconds'),
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'numpy': np.__version__,
+            'database_profile': os.getenv('DATABASE_PROFILE', 'default'),
+            'password_hash_method': app_module.app.config['PASSWORD_HASH_METHOD'],
+            'repeat': repeat,
+            'seed': seed,
+        },
+        'views': {},
+    }
+    for size in sorted(sizes):
+        time_start = time.perf_counter()
+        count = seed_to(app_module, size, rng)
+        click.echo('{} 条记录，生成用时 {:.1f} 秒'.format(count, time.perf_counter() - time_start), err=True)
+        results['views'][str(size)] = bench_views(app_module, counter, repeat, rng)
+        for name, stats in results['views'][str(size)].items():
+            click.echo('  {:<18} p50 {:8.2f} ms  p99 {:8.2f} ms  SQL {:.1f}'.format(
+                name, stats['p50_ms'], stats['p99_ms'], stats['queries_mean']), err=True)
+    results['formula'] = bench_formula(repeat)
+    for name, stats in results['formula'].items():
+        click.echo('  {:<55} p50 {:10.4f} ms  {:8.2f} ns/元素'.format(
+            name, stats['p50_ms'], stats['ns_per_element']), err=True)
+
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    click.echo('结果已写入 {}'.format(output), err=True)
+    if directory is not None:
+        with app_module.app.app_context():
+            app_module.db.engine.dispose()
+        directory.cleanup()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
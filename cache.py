@@ -0,0 +1,109 @@
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """线程安全的进程内缓存：最多存 maxsize 条（超出时淘汰最久没用的），每条存活 ttl 秒，并统计命中 / 未命中次数"""
+
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()  # key -> (过期时刻, value)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[0] <= time.monotonic():
+                if item is not None:
+                    del self._data[key]  # 已过期
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            item = self._data.pop(key, None)
+            return None if item is None else item[1]
+
+    def invalidate(self, predicate):
+        """删掉所有 predicate(key) 为真的条目，返回删掉的条数"""
+        with self._lock:
+            list_key = [key for key in self._data if predicate(key)]
+            for key in list_key:
+                del self._data[key]
+            return len(list_key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class FragmentCache:
+    """线程安全的 LRU 缓存，按占用的内存（字节）而不是条数限制大小，用来存渲染好的 HTML 片段。
+
+    每条带一个 version：取的时候 version 对不上就算未命中（内容已变），由调用方重新渲染后覆盖。
+    """
+
+    def __init__(self, maxbytes=16 * 1024 * 1024):
+        self.maxbytes = maxbytes
+        self.nbytes = 0  # 当前占用，按 sys.getsizeof 估算键、版本与片段
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()  # key -> (version, value, 字节数)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, version):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[0] != version:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def set(self, key, version, value):
+        size = sys.getsizeof(key) + sys.getsizeof(version) + sys.getsizeof(value)
+        if size > self.maxbytes:
+            return
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.nbytes -= old[2]
+            self._data[key] = (version, value, size)
+            self.nbytes += size
+            while self.nbytes > self.maxbytes:
+                self.nbytes -= self._data.popitem(last=False)[1][2]
+
+    def pop(self, key):
+        with self._lock:
+            item = self._data.pop(key, None)
+            if item is None:
+                return None
+            self.nbytes -= item[2]
+            return item[1]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.nbytes = 0
@@ -1,22 +1,171 @@
-def cal_the_complex_of_1_and_2_generation_of_Ha_0(x1=0, x2=0):
-    """第一、二代棉铃虫复合为害与产量损失的回归模型，原始公式"""
-    y0 = 13.40232 + 4.65075 * x1 + 4.999563 * x2 + 0.624735 * x1**2 + 3.876875 * x2**2 - 1.93 * x1 * x2
-    return y0
+import numpy as np
 
+# 回归系数，顺序为：常数项、X1、X2、X1^2、X2^2、X1*X2
+COEF = (13.40232, 4.65075, 4.999563, 0.624735, 3.876875, -1.93)
+LEVEL_X1 = 50  # 一代棉铃虫 50 头/百株 规定为“1”
+LEVEL_X2 = 300  # 二代棉铃虫 300 头/百株 规定为“1”
 
-def cal_the_complex_of_1_and_2_generation_of_Ha(X1, X2):
+
+def _as_float_array(X):
+    """把 list、ndarray 或任何支持缓冲区协议的对象（array.array、memoryview……）转成 float64 数组，类型已对时不复制"""
+    return np.asarray(X, dtype=np.float64)
+
+
+def _scaled_coef(coef, level):
+    """level=True 时把 /50、/300 的水平换算并进系数里，这样就不用为 X1/50、X2/300 另开临时数组"""
+    c0, c1, c2, c11, c22, c12 = coef
+    if not level:
+        return coef
+    return (c0, c1 / LEVEL_X1, c2 / LEVEL_X2, c11 / LEVEL_X1**2,
+            c22 / LEVEL_X2**2, c12 / (LEVEL_X1 * LEVEL_X2))
+
+
+def cal_the_complex_of_1_and_2_generation_of_Ha_batch(X1,
+                                                      X2,
+                                                      level=False,
+                                                      coef=COEF,
+                                                      out=None):
+    """第一、二代棉铃虫复合为害与产量损失的回归模型，批量版本。一次算完整批 (X1, X2)，返回 ndarray
+
+    level=True 表示 X1、X2 是原始的“头/百株”，按 50、300 头/百株 换算成水平；
+    out 可传入预先分配好的 float64 数组（不要与 X1、X2 共用内存），结果直接写进去。
+    """
+    X1 = _as_float_array(X1)
+    X2 = _as_float_array(X2)
+    c0, c1, c2, c11, c22, c12 = _scaled_coef(coef, level)
+    shape = np.broadcast_shapes(X1.shape, X2.shape)
+    if out is None:
+        out = np.empty(shape, dtype=np.float64)
+    tmp = np.empty(shape, dtype=np.float64)  # 唯一的一块临时空间
+    # Y = c0 + X1 * (c1 + c11*X1 + c12*X2) + X2 * (c2 + c22*X2)
+    np.multiply(X1, c11, out=out)
+    np.multiply(X2, c12, out=tmp)
+    out += tmp
+    out += c1
+    out *= X1
+    np.multiply(X2, c22, out=tmp)
+    tmp += c2
+    tmp *= X2
+    out += tmp
+    out += c0
+    return out
+
+
+def cal_1_batch(X1, level=False, coef=COEF, out=None):
+    """一代棉铃虫的为害效应模型，批量版本"""
+    X1 = _as_float_array(X1)
+    c0, c1 = _scaled_coef(coef, level)[:2]
+    if out is None:
+        out = np.empty(X1.shape, dtype=np.float64)
+    np.multiply(X1, c1, out=out)
+    out += c0
+    return out
+
+
+def cal_2_batch(X2, level=False, coef=COEF, out=None):
+    """二代棉铃虫的为害效应模型，批量版本"""
+    X2 = _as_float_array(X2)
+    c0, _, c2, _, c22, _ = _scaled_coef(coef, level)
+    if out is None:
+        out = np.empty(X2.shape, dtype=np.float64)
+    np.multiply(X2, c22, out=out)
+    out += c2
+    out *= X2
+    out += c0
+    return out
+
+
+def cal_the_complex_of_1_and_2_generation_of_Ha_0(x1=0, x2=0, level=False, coef=COEF):
+    """第一、二代棉铃虫复合为害与产量损失的回归模型，原始公式；coef 可换成自己拟合的系数"""
+    y0 = cal_the_complex_of_1_and_2_generation_of_Ha_batch(x1, x2, level, coef)
+    return float(y0)
+
+
+def cal_the_complex_of_1_and_2_generation_of_Ha(X1, X2, level=False):
     """第一、二代棉铃虫复合为害与产量损失的回归模型，简化公式（剔除极不显著的X1^2和X1*X2两项）"""
-    Y = 13.40232 + 4.65075 * X1 + 4.999563 * X2 + 0.624735 * X1**2 + 3.876875 * X2**2 - 1.93 * X1 * X2
-    return Y
+    Y = cal_the_complex_of_1_and_2_generation_of_Ha_batch(X1, X2, level)
+    return float(Y)
 
 
-def cal_1(X1):
+def cal_1(X1, level=False):
     """一代棉铃虫的为害效应模型"""
-    Y1 = 13.40232 + 4.65075 * X1
-    return Y1
+    Y1 = cal_1_batch(X1, level)
+    return float(Y1)
 
 
-def cal_2(X2):
+def cal_2(X2, level=False):
     """一代棉铃虫的为害效应模型"""
-    Y2 = 13.40232 + 4.999563 * X2 + 3.876875 * X2**2
-    return Y2
\ No newline at end of file
+    Y2 = cal_2_batch(X2, level)
+    return float(Y2)
+
+
+# 防治指标公式 Y = E×C×100%／(H×P×F×R) 的默认参数（2003~2005 年喀什棉区）
+CONTROL_DEFAULT = {
+    'e': 2,  # 生态学系数
+    'c': 9.50,  # 防治一次各种费用之和，元/亩
+    'h': 90,  # 大田平均产量，kg/亩
+    'p': 9.80,  # 农产品单价，元/kg
+    'f': 0.7,  # 害虫为害造成的最大损失率
+    'r': 0.8,  # 防治一次的防治效果
+}
+
+
+def cal_allowed_loss(E, C, H, P, F, R):
+    """防治指标公式，批量版本：允许产量损失率 Y(%) = E×C×100／(H×P×F×R)"""
+    return (_as_float_array(E) * C * 100) / (_as_float_array(H) * P * F * R)
+
+
+def solve_threshold_x2(Y, X1, level=False, coef=COEF):
+    """反解回归模型：在给定 X1 下，为害造成的损失（扣除常数项，即无虫时的损失）达到 Y 时的 X2，批量版本
+
+    Y 与 X1 可互相广播（如 Y 为各地区的列向量、X1 为一行网格）。X1 单独已达到 Y 时为 0，X2 再大也达不到时为 nan。
+    """
+    Y = _as_float_array(Y)
+    X1 = _as_float_array(X1)
+    _, c1, c2, c11, c22, c12 = _scaled_coef(coef, level)
+    # c22*X2^2 + (c2 + c12*X1)*X2 + (c1*X1 + c11*X1^2 - Y) = 0，取最小的非负根
+    b = c2 + c12 * X1
+    c = (c1 + c11 * X1) * X1 - Y
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if c22:
+            root = (-b + np.sqrt(b * b - 4 * c22 * c)) / (2 * c22)
+        else:
+            root = -c / b
+    root = np.where(root >= 0, root, np.nan)
+    return np.where(c >= 0, 0.0, root)
+
+
+def solve_threshold_x1(Y, level=False, coef=COEF):
+    """没有二代虫时，一代虫的防治指标：X2=0 下为害造成的损失达到 Y 时的 X1，批量版本"""
+    c0, c1, _, c11, _, _ = coef
+    # 与 X2 对称：把 X1 当作 solve_threshold_x2 里的 X2、X1 取 0
+    swapped = (c0, 0, c1, 0, c11, 0)
+    X1 = solve_threshold_x2(Y, 0, coef=swapped)
+    return X1 * LEVEL_X1 if level else X1
+
+
+def design_matrix(X1, X2, level=False):
+    """回归模型的设计矩阵，每行为 [1, X1, X2, X1^2, X2^2, X1*X2]，与 COEF 同序"""
+    X1 = _as_float_array(X1).ravel()
+    X2 = _as_float_array(X2).ravel()
+    if level:
+        X1 = X1 / LEVEL_X1
+        X2 = X2 / LEVEL_X2
+    return np.column_stack((np.ones_like(X1), X1, X2, X1 * X1, X2 * X2, X1 * X2))
+
+
+def fit_moments(M):
+    """由矩阵 M = ZᵀZ（Z 的每行为 [设计矩阵的一行, Y]）用最小二乘求回归系数，返回 (coef, r2)
+
+    M 左上 6×6 即 XᵀX，最后一列即 Xᵀy，M[0, 0] 为记录条数。记录太少或 X1、X2 共线（XᵀX 不满秩）时返回 (None, None)。
+    """
+    M = _as_float_array(M)
+    XtX, Xty, yty = M[:6, :6], M[:6, 6], M[6, 6]
+    n = XtX[0, 0]
+    if n < 6 or np.linalg.matrix_rank(XtX) < 6:
+        return None, None
+    coef = np.linalg.solve(XtX, Xty)
+    sse = yty - 2 * coef @ Xty + coef @ XtX @ coef  # 残差平方和
+    sst = yty - Xty[0] * Xty[0] / n  # 总平方和
+    r2 = 1 - sse / sst if sst > 0 else 1.0
+    return tuple(coef.tolist()), float(r2)
@@ -0,0 +1,81 @@
+import bisect
+import threading
+
+# 直方图默认的桶上界（秒）
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace(
+        '"', '\\"').replace('\n', '\\n')) for key, value in labels) + '}'
+
+
+def _format_value(value):
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Metrics:
+    """线程安全的进程内指标：计数器、仪表、直方图，都按标签分别累计，render() 输出 Prometheus 文本格式。
+
+    每个 worker 进程各自统计，多进程部署时由 Prometheus 分别抓取再汇总。
+    """
+
+    def __init__(self, prefix=''):
+        self.prefix = prefix
+        self._kind = {}  # name -> (类型, 说明, 直方图的桶)
+        self._values = {}  # (name, labels) -> 数值；直方图为 [各桶计数, 总和, 次数]
+        self._lock = threading.Lock()
+
+    def describe(self, name, kind, help_, buckets=BUCKETS):
+        """登记一个指标，kind 为 counter、gauge 或 histogram"""
+        self._kind[name] = (kind, help_, tuple(buckets))
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self._values[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name, value, **labels):
+        buckets = self._kind[name][2]
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            item = self._values.get(key)
+            if item is None:
+                item = self._values[key] = [[0] * len(buckets), 0.0, 0]
+            index = bisect.bisect_left(buckets, value)  # 落在第一个上界 >= value 的桶里
+            if index < len(buckets):
+                item[0][index] += 1
+            item[1] += value
+            item[2] += 1
+
+    def render(self):
+        with self._lock:
+            values = sorted((key, list(value[0]) + [value[1], value[2]] if isinstance(value, list) else value)
+                            for key, value in self._values.items())
+        lines = []
+        for name, (kind, help_, buckets) in self._kind.items():
+            full_name = self.prefix + name
+            lines.append('# HELP {} {}'.format(full_name, help_))
+            lines.append('# TYPE {} {}'.format(full_name, kind))
+            for (name_, labels), value in values:
+                if name_ != name:
+                    continue
+                if kind != 'histogram':
+                    lines.append('{}{} {}'.format(full_name, _format_labels(labels), _format_value(value)))
+                    continue
+                cumulative = 0
+                for le, count in zip(buckets, value[:len(buckets)]):
+                    cumulative += count
+                    lines.append('{}_bucket{} {}'.format(
+                        full_name, _format_labels(labels + (('le', _format_value(le)), )), cumulative))
+                lines.append('{}_bucket{} {}'.format(
+                    full_name, _format_labels(labels + (('le', '+Inf'), )), value[-1]))
+                lines.append('{}_sum{} {}'.format(full_name, _format_labels(labels), repr(float(value[-2]))))
+                lines.append('{}_count{} {}'.format(full_name, _format_labels(labels), value[-1]))
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,99 @@
+import base64
+import struct
+import zlib
+
+import numpy as np
+
+import formula
+
+# 近似 viridis 的色带，按 0、0.25、0.5、0.75、1 五个位置插值
+COLORMAP_STOPS = np.array([0, 0.25, 0.5, 0.75, 1])
+COLORMAP_RGB = np.array([[68, 1, 84], [59, 82, 139], [33, 145, 140],
+                         [94, 201, 98], [253, 231, 37]])
+
+
+def cal_loss_surface(x1_min, x1_max, x1_steps, x2_min, x2_max, x2_steps,
+                     level=True):
+    """在 (x1, x2) 网格上计算产量损失率曲面，以及 cal_1、cal_2 两条边际曲线。
+
+    x1 取列向量、x2 取行向量，靠 numpy 广播一次算出 x1_steps × x2_steps 的整张曲面，返回 dict。
+    """
+    x1 = np.linspace(x1_min, x1_max, x1_steps)
+    x2 = np.linspace(x2_min, x2_max, x2_steps)
+    y = formula.cal_the_complex_of_1_and_2_generation_of_Ha_batch(
+        x1[:, np.newaxis], x2[np.newaxis, :], level=level)
+    return {
+        'x1': x1,
+        'x2': x2,
+        'y': y,  # y[i, j] 对应 (x1[i], x2[j])
+        'y1': formula.cal_1_batch(x1, level=level),
+        'y2': formula.cal_2_batch(x2, level=level),
+    }
+
+
+def colorize(y):
+    """把曲面按最小~最大值映射到色带，返回 uint8 的 (行, 列, 3) 图像：横轴 x1，纵轴 x2（上大下小）"""
+    y = y.T[::-1]
+    span = y.max() - y.min()
+    t = (y - y.min()) / span if span else np.zeros_like(y)
+    rgb = np.empty(y.shape + (3, ), dtype=np.uint8)
+    for channel in range(3):
+        rgb[..., channel] = np.interp(t, COLORMAP_STOPS,
+                                      COLORMAP_RGB[:, channel])
+    return rgb
+
+
+def _png_chunk(tag, data):
+    return struct.pack('>I', len(data)) + tag + data + struct.pack(
+        '>I', zlib.crc32(tag + data) & 0xffffffff)
+
+
+def encode_png(rgb, scale=1):
+    """不依赖绘图库，把 uint8 的 RGB 图像编码成 PNG；scale 把每个格子放大成 scale × scale 像素"""
+    if scale > 1:
+        rgb = rgb.repeat(scale, axis=0).repeat(scale, axis=1)
+    height, width = rgb.shape[:2]
+    raw = np.zeros((height, width * 3 + 1), dtype=np.uint8)  # 每行开头一个字节的过滤类型 0
+    raw[:, 1:] = rgb.reshape(height, width * 3)
+    return (b'\x89PNG\r\n\x1a\n' +
+            _png_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)) +
+            _png_chunk(b'IDAT', zlib.compress(raw.tobytes(), 9)) +
+            _png_chunk(b'IEND', b''))
+
+
+def encode_svg(surface, width=480, height=360):
+    """带坐标轴与色标的热力图 SVG，热力图本身以内嵌 PNG 呈现"""
+    png = base64.b64encode(encode_png(colorize(surface['y']))).decode('ascii')
+    x1, x2, y = surface['x1'], surface['x2'], surface['y']
+    left, top, right, bottom = 60, 20, 90, 50
+    plot_w, plot_h = width - left - right, height - top - bottom
+    parts = [
+        '<svg xmlns="http://www.w3.org/2000/svg" width="{}" height="{}" '
+        'font-family="sans-serif" font-size="11">'.format(width, height),
+        '<image x="{}" y="{}" width="{}" height="{}" preserveAspectRatio="none" '
+        'style="image-rendering:pixelated" href="data:image/png;base64,{}"/>'.format(
+            left, top, plot_w, plot_h, png),
+        '<rect x="{}" y="{}" width="{}" height="{}" fill="none" stroke="#333"/>'.format(
+            left, top, plot_w, plot_h),
+    ]
+    for t in np.linspace(0, 1, 5):
+        px = left + t * plot_w
+        py = top + (1 - t) * plot_h
+        parts.append('<text x="{:.1f}" y="{}" text-anchor="middle">{:g}</text>'.format(
+            px, top + plot_h + 15, round(x1[0] + t * (x1[-1] - x1[0]), 1)))
+        parts.append('<text x="{}" y="{:.1f}" text-anchor="end">{:g}</text>'.format(
+            left - 5, py + 4, round(x2[0] + t * (x2[-1] - x2[0]), 1)))
+    parts.append('<text x="{}" y="{}" text-anchor="middle">X1（一代，头/百株）</text>'.format(
+        left + plot_w / 2, height - 10))
+    parts.append('<text transform="translate(15,{}) rotate(-90)" text-anchor="middle">'
+                 'X2（二代，头/百株）</text>'.format(top + plot_h / 2))
+    bar = np.linspace(0, 1, 64)[np.newaxis, :]  # 色标：colorize 转置翻转后从上到下由大到小
+    bar_png = base64.b64encode(encode_png(colorize(bar))).decode('ascii')
+    bar_x = left + plot_w + 15
+    parts.append('<image x="{}" y="{}" width="15" height="{}" preserveAspectRatio="none" '
+                 'href="data:image/png;base64,{}"/>'.format(bar_x, top, plot_h, bar_png))
+    parts.append('<text x="{}" y="{}">{:.1f}%</text>'.format(bar_x + 20, top + 10, y.max()))
+    parts.append('<text x="{}" y="{}">{:.1f}%</text>'.format(bar_x + 20, top + plot_h, y.min()))
+    parts.append('<text x="{}" y="{}">Y</text>'.format(bar_x, top + plot_h + 15))
+    parts.append('</svg>')
+    return '\n'.join(parts)
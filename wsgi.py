@@ -11,5 +11,8 @@ if os.path.exists(dotenv_path):
 
 # 这两个环境变量的具体定义，我们将在远程服务器环境创建新的 .env 文件写入。
 
-import app
+# 导入的是 Flask 程序实例（而不是 app 模块），WSGI 服务器才能找到它。
+# 程序里已经没有按用户区分的模块级全局变量，可以放心用多进程、多线程的服务器，例如：
+#   gunicorn -w 4 --threads 4 wsgi:app
+from app import app
 print("Checked.")
\ No newline at end of file